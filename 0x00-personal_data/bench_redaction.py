@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the PII redaction of log lines and user dumps.
+
+    ./bench_redaction.py --save baseline.json
+    ./bench_redaction.py --baseline baseline.json
+    ./bench_redaction.py parallel --workers 8
+    ./bench_redaction.py export --rows 1000000
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from filtered_logger import (
+    BATCH_SIZE,
+    CHUNK_SIZE,
+    PII_FIELDS,
+    USER_COLUMNS,
+    RedactingFormatter,
+    export_users,
+    filter_datum,
+    get_logger,
+    main,
+    redact_batch,
+    redact_batches_parallel,
+)
+
+
+COLUMNS = list(USER_COLUMNS)
+MESSAGE_LENGTHS = (64, 512, 4096)
+FIELD_COUNTS = (1, 3, len(PII_FIELDS))
+PII_RATIOS = (0.0, 0.25, 1.0)
+SEPARATORS = (";", "|")
+
+
+def make_rows(count: int) -> List[tuple]:
+    """Builds synthetic users rows."""
+    return [
+        (
+            "user{}".format(i),
+            "user{}@example.com".format(i),
+            "(555) 555-{:04d}".format(i % 10000),
+            "{:03d}-{:02d}-{:04d}".format(i % 1000, i % 100, i % 10000),
+            "$2b$12${:0>53}".format(i),
+            "10.0.{}.{}".format(i // 256 % 256, i % 256),
+            "2019-11-14T06:16:24",
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+        )
+        for i in range(count)
+    ]
+
+
+def make_db(path: str, rows: List[tuple]) -> None:
+    """Creates an sqlite3 users table holding the given rows."""
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE users ({});".format(", ".join(COLUMNS)))
+    connection.executemany(
+        "INSERT INTO users VALUES ({});".format(", ".join("?" * len(COLUMNS))),
+        rows,
+    )
+    connection.commit()
+    connection.close()
+
+
+def make_message(
+    length: int, fields: List[str], pii_ratio: float, separator: str
+) -> str:
+    """
+    Builds a log message of about length characters in which
+    pii_ratio of the key=value pairs use one of the fields
+    """
+    pairs = []
+    size = 0
+    for i in itertools.count():
+        if size >= length:
+            break
+        if pii_ratio and (i * pii_ratio) % 1 + pii_ratio >= 1:
+            key = fields[i % len(fields)]
+        else:
+            key = ("ip", "last_login", "user_agent")[i % 3]
+        pair = "{}=value{}".format(key, i)
+        pairs.append(pair)
+        size += len(pair) + len(separator)
+    return separator.join(pairs) + separator
+
+
+def measure(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Times repeat calls of func, returning ops/s and percentiles."""
+    timings = []
+    clock = time.perf_counter_ns
+    for _ in range(repeat):
+        start = clock()
+        func()
+        timings.append(clock() - start)
+    timings.sort()
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] / 1e3
+
+    return {
+        "ops": repeat / (sum(timings) / 1e9),
+        "p50_us": percentile(0.50),
+        "p90_us": percentile(0.90),
+        "p99_us": percentile(0.99),
+    }
+
+
+def bench_suite(repeat: int, rows: List[tuple]) -> Dict[str, dict]:
+    """
+    Runs filter_datum and RedactingFormatter.format across the
+    message shapes, then the main() dump of rows
+    """
+    results = {}
+    for length, count, ratio, separator in itertools.product(
+        MESSAGE_LENGTHS, FIELD_COUNTS, PII_RATIOS, SEPARATORS
+    ):
+        fields = list(PII_FIELDS[:count])
+        message = make_message(length, fields, ratio, separator)
+        name = "len={},fields={},pii={},sep={}".format(
+            length, count, ratio, separator
+        )
+        results["filter_datum " + name] = measure(
+            lambda: filter_datum(fields, "***", message, separator), repeat
+        )
+        if separator != RedactingFormatter.SEPARATOR:
+            continue
+        formatter = RedactingFormatter(fields)
+        record = logging.LogRecord(
+            "user_data", logging.INFO, None, None, message, None, None
+        )
+        results["format " + name] = measure(
+            lambda: formatter.format(record), repeat
+        )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "users.db")
+        make_db(db_path, rows)
+        with open(os.devnull, "w", buffering=CHUNK_SIZE) as devnull:
+            get_logger().handlers[0].setStream(devnull)
+            dump = measure(lambda: main(connection=sqlite3.connect(db_path)),
+                           3)
+        results["main rows={}".format(len(rows))] = {
+            "ops": dump["ops"] * len(rows),
+            "p50_us": dump["p50_us"] / len(rows),
+            "p90_us": dump["p90_us"] / len(rows),
+            "p99_us": dump["p99_us"] / len(rows),
+        }
+    return results
+
+
+def report(results: Dict[str, dict], baseline: Dict[str, dict] = None,
+           tolerance: float = 0.2) -> int:
+    """
+    Prints the results, next to the baseline when given, and
+    returns the number of cases slower than the tolerance
+    """
+    regressions = 0
+    print("{:<48} {:>12} {:>9} {:>9} {:>9} {:>8}".format(
+        "case", "ops/s", "p50 us", "p90 us", "p99 us", "vs base"
+    ))
+    for name, stats in results.items():
+        change = ""
+        base = (baseline or {}).get(name)
+        if base is not None:
+            ratio = stats["ops"] / base["ops"]
+            change = "{:.2f}x".format(ratio)
+            if ratio < 1 - tolerance:
+                change += " !"
+                regressions += 1
+        print("{:<48} {:>12.0f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8}".format(
+            name, stats["ops"], stats["p50_us"], stats["p90_us"],
+            stats["p99_us"], change
+        ))
+    return regressions
+
+
+def bench_parallel(rows: List[tuple], max_workers: int,
+                   batch_size: int = BATCH_SIZE) -> None:
+    """Reports the rows/s of the redaction from 1 to max_workers."""
+    batches = [
+        rows[i:i + batch_size] for i in range(0, len(rows), batch_size)
+    ]
+    print("{:>8} {:>12} {:>8}".format("workers", "rows/s", "speedup"))
+    base = None
+    for workers in range(1, max_workers + 1):
+        start = time.perf_counter()
+        if workers == 1:
+            for batch in batches:
+                redact_batch(COLUMNS, batch)
+        else:
+            for _ in redact_batches_parallel(COLUMNS, batches, workers):
+                pass
+        rate = len(rows) / (time.perf_counter() - start)
+        base = base or rate
+        print("{:>8} {:>12.0f} {:>7.2f}x".format(workers, rate, rate / base))
+
+
+def bench_export(rows: List[tuple], batch_size: int = BATCH_SIZE) -> None:
+    """
+    Compares the logger based dump of a users table with the
+    JSON lines and CSV exports
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "users.db")
+        make_db(db_path, rows)
+        with open(os.devnull, "w", buffering=CHUNK_SIZE) as devnull:
+            get_logger().handlers[0].setStream(devnull)
+            start = time.perf_counter()
+            main(batch_size, sqlite3.connect(db_path))
+            base = time.perf_counter() - start
+            print("{:>8} {:>12.0f} rows/s".format("logger", len(rows) / base))
+            for fmt in ("jsonl", "csv"):
+                start = time.perf_counter()
+                connection = sqlite3.connect(db_path)
+                export_users(devnull, fmt, batch_size, connection)
+                elapsed = time.perf_counter() - start
+                print("{:>8} {:>12.0f} rows/s {:>7.2f}x".format(
+                    fmt, len(rows) / elapsed, base / elapsed
+                ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "bench", nargs="?", default="suite",
+        choices=("suite", "parallel", "export"),
+    )
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--baseline", help="json results to compare with")
+    parser.add_argument("--save", help="write the suite results as json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    cli_args = parser.parse_args()
+    rows = make_rows(cli_args.rows)
+    if cli_args.bench == "export":
+        bench_export(rows, cli_args.batch_size)
+    elif cli_args.bench == "parallel":
+        bench_parallel(rows, cli_args.workers, cli_args.batch_size)
+    else:
+        baseline = None
+        if cli_args.baseline is not None:
+            with open(cli_args.baseline) as f:
+                baseline = json.load(f)
+        results = bench_suite(cli_args.repeat, rows)
+        if cli_args.save is not None:
+            with open(cli_args.save, "w") as f:
+                json.dump(results, f, indent=2)
+        if report(results, baseline, cli_args.tolerance):
+            sys.exit(1)
@@ -1,14 +1,145 @@
 #!/usr/bin/env python3
 """A module for encrypting passwords.
+
+The bcrypt cost is set per deployment with BCRYPT_ROUNDS, or
+calibrated for a verification latency of BCRYPT_TARGET_MS
+milliseconds the first time it is needed: call get_rounds() on
+startup so that no request pays for it.
 """
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+)
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+import os
+import time
 import bcrypt
 
 
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 4
+MAX_ROUNDS = 20
+
+
+def calibrate_rounds(target_ms: float = 250.0) -> int:
+    """
+    Picks the highest cost whose verification fits in target_ms,
+    timing one hash at each cost from the lowest up: a verification
+    does the same work as a hash, and each cost doubles it
+    """
+    sample = b"calibration"
+    rounds = MIN_ROUNDS
+    while rounds < MAX_ROUNDS:
+        start = time.perf_counter()
+        bcrypt.hashpw(sample, bcrypt.gensalt(rounds + 1))
+        if (time.perf_counter() - start) * 1000 > target_ms:
+            break
+        rounds += 1
+    return rounds
+
+
+@lru_cache(maxsize=None)
+def get_rounds() -> int:
+    """Returns the bcrypt cost of this deployment."""
+    rounds = os.getenv("BCRYPT_ROUNDS")
+    if rounds:
+        return int(rounds)
+    target_ms = os.getenv("BCRYPT_TARGET_MS")
+    if target_ms:
+        return calibrate_rounds(float(target_ms))
+    return DEFAULT_ROUNDS
+
+
 def hash_password(password: str) -> bytes:
     """Hashes a password using a random salt."""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    salt = bcrypt.gensalt(get_rounds())
+    return bcrypt.hashpw(password.encode("utf-8"), salt)
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """Checks if a hashed password uses another cost than the policy."""
+    try:
+        return int(hashed_password.split(b"$")[2]) != get_rounds()
+    except (IndexError, ValueError):
+        return True
+
+
+def is_valid(
+    hashed_password: bytes,
+    password: str,
+    on_rehash: Callable[[bytes], None] = None,
+) -> bool:
+    """Checks is a hashed password was formed from the given password.
+    When it was but with an outdated cost, on_rehash is given a new
+    hash of the password to store in place of the old one.
+    """
+    valid = bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+    if valid and on_rehash is not None and needs_rehash(hashed_password):
+        on_rehash(hash_password(password))
+    return valid
+
+
+def _imap_unordered(
+    func: Callable[..., Any], items: Iterable[tuple], workers: int = None
+) -> Iterator[Tuple[int, Any]]:
+    """Runs func over items on a thread pool, yielding (index, result)
+    pairs as they finish. bcrypt releases the GIL while hashing, so the
+    threads use every core. At most four calls per worker are queued.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {}
+        for index, args in enumerate(items):
+            pending[executor.submit(func, *args)] = index
+            if len(pending) < 4 * workers:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        for future in as_completed(list(pending)):
+            yield pending.pop(future), future.result()
+
+
+def iter_hash_passwords(
+    passwords: Iterable[str], workers: int = None
+) -> Iterator[Tuple[int, bytes]]:
+    """Hashes passwords in parallel, yielding (index, hash) pairs in
+    completion order.
+    """
+    items = ((password,) for password in passwords)
+    return _imap_unordered(hash_password, items, workers)
+
+
+def hash_passwords_many(
+    passwords: Iterable[str], workers: int = None
+) -> List[bytes]:
+    """Hashes passwords in parallel, keeping the input order."""
+    results = {}
+    for index, hashed in iter_hash_passwords(passwords, workers):
+        results[index] = hashed
+    return [results[index] for index in range(len(results))]
+
+
+def iter_verify(
+    pairs: Iterable[Tuple[bytes, str]], workers: int = None
+) -> Iterator[Tuple[int, bool]]:
+    """Checks (hashed_password, password) pairs in parallel, yielding
+    (index, valid) pairs in completion order.
+    """
+    return _imap_unordered(is_valid, pairs, workers)
+
+
+def verify_many(
+    pairs: Iterable[Tuple[bytes, str]], workers: int = None
+) -> List[bool]:
+    """Checks (hashed_password, password) pairs in parallel, keeping
+    the input order.
+    """
+    results = {}
+    for index, valid in iter_verify(pairs, workers):
+        results[index] = valid
+    return [results[index] for index in range(len(results))]
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
-    """Checks is a hashed password was formed from the given password."""
-    return bcrypt.checkpw(password.encode("utf-8"), hashed_password)
+if __name__ == "__main__":
+    print(calibrate_rounds(float(os.getenv("BCRYPT_TARGET_MS", "250"))))
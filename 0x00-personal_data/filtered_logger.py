@@ -2,19 +2,87 @@
 """
 Module that implements a PII functions
 """
-from typing import List
+from typing import (
+    Any, BinaryIO, Callable, Iterable, Iterator, List, Mapping, TextIO, Tuple
+)
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import argparse
+import atexit
+import copy
+import json
+import queue
 import re
 import logging
+import logging.handlers
 import os
+import sys
+import threading
+import time
 import mysql.connector
 
 
 patterns = {
     "extract": lambda x, y: r"(?P<field>{})=[^{}]*".format("|".join(x), y),
+    "extract_line": lambda x, y: (
+        r"(?P<field>{0})=[^{1}\r\n]*(?:\r(?!\n)[^{1}\r\n]*)*"
+        .format("|".join(x), y)
+    ),
     "replace": lambda x: r"\g<field>={}".format(x),
 }
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+USER_COLUMNS = (
+    "name", "email", "phone", "ssn", "password",
+    "ip", "last_login", "user_agent",
+)
+EXPORT_FORMATS = ("jsonl", "csv")
+CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 1000
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+CSV_SPECIAL = re.compile(r'[,"\r\n]')
+
+
+class Redactor:
+    """
+    Compiled redaction engine for a fixed set of fields. With
+    lines, values also end at a LF or CRLF line ending, while a
+    lone carriage return stays part of the value
+    """
+
+    def __init__(self, fields: Tuple[str, ...], separator: str,
+                 redaction: str, lines: bool = False):
+        self.fields = fields
+        self.separator = separator
+        self.redaction = redaction
+        extract = patterns["extract_line" if lines else "extract"]
+        replace = patterns["replace"]
+        self._regex = re.compile(extract(fields, separator))
+        self._replace = replace(redaction)
+        self._needles = None
+        if fields and all(re.escape(field) == field for field in fields):
+            self._needles = tuple("{}=".format(field) for field in fields)
+
+    def redact(self, message: str) -> str:
+        """
+        Redacts the fields in a message, skipping the regex
+        when none of the field names occur in it
+        """
+        if self._needles is not None and \
+                not any(needle in message for needle in self._needles):
+            return message
+        return self._regex.sub(self._replace, message)
+
+
+@lru_cache(maxsize=128)
+def get_redactor(
+    fields: Tuple[str, ...], separator: str, redaction: str,
+    lines: bool = False
+) -> Redactor:
+    """Returns the cached redaction engine for the given parameters."""
+    return Redactor(fields, separator, redaction, lines)
 
 
 def filter_datum(
@@ -23,21 +91,123 @@ def filter_datum(
     """
     Fitlers a log line based on provided parameters of the func
     """
-    extract, replace = (patterns["extract"], patterns["replace"])
-    return re.sub(extract(fields, separator), replace(redaction), message)
+    return get_redactor(tuple(fields), separator, redaction).redact(message)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that hands records over to a bounded queue
+    and applies an overflow policy when the queue is full
+    """
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = "block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Merges the message arguments but leaves the formatting
+        and redaction to the listener thread
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Puts a record on the queue according to the overflow policy."""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.overflow == "drop-newest":
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener that waits for room in a full queue
+    before asking its thread to stop
+    """
+
+    def enqueue_sentinel(self) -> None:
+        """Blocks until the stop sentinel fits in the queue."""
+        self.queue.put(self._sentinel)
+
+
+_listener = None
 
 
-def get_logger() -> logging.Logger:
-    """Creates a new logger for user data."""
+def get_logger(
+    asynchronous: bool = None,
+    queue_size: int = 10000,
+    overflow: str = "block",
+) -> logging.Logger:
+    """
+    Creates a new logger for user data. With asynchronous set,
+    records go through a bounded queue and are formatted,
+    redacted and written on a background listener thread.
+    The logger is configured on the first call, synchronous
+    unless asked otherwise, and again when a call switches it
+    between the two modes: with asynchronous left to None, a
+    configured logger is returned as it is.
+    """
+    global _listener
     logger = logging.getLogger("user_data")
+    if logger.handlers and asynchronous in (None, _listener is not None):
+        return logger
+    shutdown_logger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
     logger.setLevel(logging.INFO)
     logger.propagate = False
-    logger.addHandler(stream_handler)
+    if asynchronous:
+        log_queue = queue.Queue(queue_size)
+        logger.addHandler(BoundedQueueHandler(log_queue, overflow))
+        _listener = FlushingQueueListener(log_queue, stream_handler)
+        _listener.start()
+    else:
+        logger.addHandler(stream_handler)
     return logger
 
 
+@atexit.register
+def shutdown_logger() -> None:
+    """
+    Detaches the queue handler from the user data logger, then
+    drains the queued records and stops the listener thread.
+    Later records are written synchronously by the handlers of
+    the listener.
+    """
+    global _listener
+    if _listener is not None:
+        logger = logging.getLogger("user_data")
+        for handler in list(logger.handlers):
+            if isinstance(handler, BoundedQueueHandler):
+                logger.removeHandler(handler)
+                handler.close()
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+            logger.addHandler(handler)
+        _listener = None
+
+
 def get_db() -> mysql.connector.connection.MySQLConnection:
     """Creates a connector to a database."""
     db_host = os.getenv("PERSONAL_DATA_DB_HOST", "localhost")
@@ -54,29 +224,393 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return connection
 
 
-def main():
-    """Logs the information about user records in a table."""
-    fields = "name,email,phone,ssn,password,ip,last_login,user_agent"
-    columns = fields.split(",")
-    query = "SELECT {} FROM users;".format(fields)
+def is_alive(connection: Any) -> bool:
+    """Checks that a DB-API connection still answers a query."""
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """
+    Bounded pool of reusable database connections. The
+    connections are built by the connect callable, get_db by
+    default, and health checked when they are checked out.
+    """
+
+    def __init__(
+        self,
+        size: int = 5,
+        connect: Callable[[], Any] = None,
+        health_check: Callable[[Any], bool] = is_alive,
+    ):
+        if size < 1:
+            raise ValueError("Pool size must be positive")
+        self.size = size
+        self._connect = connect if connect is not None else get_db
+        self._health_check = health_check
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: float = None) -> Any:
+        """
+        Checks out a connection, waiting up to timeout seconds
+        for a free slot and replacing idle connections that
+        fail the health check
+        """
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("No database connection available")
+        try:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._health_check(connection):
+                    return connection
+                self._discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection: Any) -> None:
+        """
+        Rolls back any open transaction and returns a connection
+        to the pool, dropping it if the rollback fails
+        """
+        try:
+            connection.rollback()
+            self._idle.put(connection)
+        except Exception:
+            self._discard(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float = None) -> Iterator[Any]:
+        """Lends a pooled connection for the duration of a block."""
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        """Closes all idle connections."""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _discard(connection: Any) -> None:
+        """Closes a connection, ignoring errors from broken ones."""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    """
+    Returns the shared pool of get_db connections, sized by
+    PERSONAL_DATA_DB_POOL_SIZE
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            size = int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", "5"))
+            _pool = ConnectionPool(size)
+        return _pool
+
+
+class RedactedLogRecord(logging.LogRecord):
+    """
+    Log record whose message has already been redacted
+    """
+
+
+def iter_batches(
+    cursor, batch_size: int = BATCH_SIZE
+) -> Iterator[List[tuple]]:
+    """
+    Yields the rows of an executed cursor in lists of at most
+    batch_size rows so the result set is never held in memory
+    at once
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_rows(cursor, batch_size: int = BATCH_SIZE) -> Iterator[tuple]:
+    """Yields the rows of an executed cursor one at a time."""
+    for rows in iter_batches(cursor, batch_size):
+        yield from rows
+
+
+def mask_row(
+    columns: List[str], row: tuple, fields: List[str], redactor: Redactor
+) -> str:
+    """
+    Builds the log message of a row with the values of the given
+    fields replaced by key, and the redactor run over each other
+    key=value pair, which redacts what it would over the whole
+    message
+    """
+    redact = redactor.redact
+    return "{};".format("; ".join(
+        "{}={}".format(column, redactor.redaction)
+        if column in fields
+        else redact("{}={}".format(column, value))
+        for column, value in zip(columns, row)
+    ))
+
+
+def redact_batch(columns: List[str], rows: List[tuple]) -> List[str]:
+    """Builds and redacts the log messages of a batch of rows."""
+    fields = frozenset(PII_FIELDS)
+    redactor = get_redactor(
+        PII_FIELDS,
+        RedactingFormatter.SEPARATOR,
+        RedactingFormatter.REDACTION,
+    )
+    return [mask_row(columns, row, fields, redactor) for row in rows]
+
+
+def redact_batches_parallel(
+    columns: List[str], batches: Iterable[List[tuple]], workers: int
+) -> Iterator[List[str]]:
+    """
+    Redacts batches of rows on a process pool and yields the
+    messages in the original order, keeping at most two
+    batches per worker in flight
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for rows in batches:
+            pending.append(executor.submit(redact_batch, columns, rows))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main(batch_size: int = BATCH_SIZE, connection=None, workers: int = 1):
+    """
+    Logs the information about user records in a table. With
+    more than one worker, the messages are built and redacted
+    on a process pool before being handed to the logger. A
+    connection passed in is left open for the caller.
+    """
+    columns = list(USER_COLUMNS)
+    query = "SELECT {} FROM users;".format(",".join(columns))
     info_logger = get_logger()
-    connection = get_db()
-    with connection.cursor() as cursor:
+    owned = connection is None
+    if owned:
+        connection = get_db()
+    cursor = connection.cursor()
+    try:
         cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            record = map(
-                lambda x: "{}={}".format(x[0], x[1]),
-                zip(columns, row),
-            )
-            msg = "{};".format("; ".join(list(record)))
-            args = ("user_data", logging.INFO, None, None, msg, None, None)
+        if workers > 1:
+            batches = iter_batches(cursor, batch_size)
+            for msgs in redact_batches_parallel(columns, batches, workers):
+                for msg in msgs:
+                    args = ("user_data", logging.INFO, None, None, msg,
+                            None, None)
+                    info_logger.handle(RedactedLogRecord(*args))
+            return
+        for row in iter_rows(cursor, batch_size):
+            args = ("user_data", logging.INFO, None, None, "", None, None)
             log_record = logging.LogRecord(*args)
+            log_record.data = dict(zip(columns, row))
             info_logger.handle(log_record)
+    finally:
+        cursor.close()
+        if owned:
+            connection.close()
+
+
+def quote_csv(value: Any) -> str:
+    """Formats a CSV field the way csv.writer does by default."""
+    if value is None:
+        return ""
+    value = str(value)
+    if CSV_SPECIAL.search(value) is None:
+        return value
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def format_csv(template: str, rows: List[tuple]) -> str:
+    """
+    Fills a CSV line template with each row of a batch. Rows of
+    strings without a delimiter, quote or line break go in as
+    they are, the others field by field through quote_csv.
+    """
+    search = CSV_SPECIAL.search
+    lines = []
+    for row in rows:
+        try:
+            text = "\x1f".join(row)
+        except TypeError:
+            text = ","
+        if search(text) is None:
+            lines.append(template % row)
+        else:
+            lines.append(template % tuple(map(quote_csv, row)))
+    return "".join(lines)
+
+
+def export_users(
+    dest: TextIO,
+    fmt: str = "jsonl",
+    batch_size: int = BATCH_SIZE,
+    connection=None,
+) -> int:
+    """
+    Writes the users table to a text stream as JSON lines or
+    CSV without going through the logging module. PII_FIELDS
+    columns are never fetched: their output slots are filled
+    with the redaction by column index. Each batch is written
+    as one string filled in from a template of the line, with
+    the redaction already encoded in it. Returns the number of
+    rows written.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format {}".format(fmt))
+    columns = list(USER_COLUMNS)
+    kept = [column for column in columns if column not in PII_FIELDS]
+    redaction = RedactingFormatter.REDACTION
+    if fmt == "csv":
+        template = "{}\r\n".format(",".join(
+            "%s" if column in kept else quote_csv(redaction).replace("%", "%%")
+            for column in columns
+        ))
+    else:
+        encode = json.JSONEncoder(default=str).encode
+        template = "{{{}}}\n".format(", ".join(
+            "{}: {}".format(
+                encode(column).replace("%", "%%"),
+                "%s" if column in kept else encode(redaction).replace(
+                    "%", "%%"
+                ),
+            )
+            for column in columns
+        ))
+    query = "SELECT {} FROM users;".format(",".join(kept))
+    owned = connection is None
+    if owned:
+        connection = get_db()
+    cursor = connection.cursor()
+    count = 0
+    try:
+        cursor.execute(query)
+        if fmt == "csv":
+            dest.write("{}\r\n".format(",".join(map(quote_csv, columns))))
+        for rows in iter_batches(cursor, batch_size):
+            if fmt == "csv":
+                dest.write(format_csv(template, rows))
+            else:
+                dest.write("".join([
+                    template % tuple(map(encode, row)) for row in rows
+                ]))
+            count += len(rows)
+    finally:
+        cursor.close()
+        if owned:
+            connection.close()
+    return count
+
+
+def redact_stream(
+    src: BinaryIO, dest: BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    Redacts PII fields from a binary stream into another one,
+    reading at most chunk_size bytes at a time. Complete lines
+    are redacted as one block, with values ending at the line
+    endings so that none runs into the next line or takes the
+    carriage return of a CRLF line ending. A chunk without a
+    line ending is cut after its last separator instead, so
+    that long lines are not held in memory.
+    """
+    redact = get_redactor(
+        PII_FIELDS,
+        RedactingFormatter.SEPARATOR,
+        RedactingFormatter.REDACTION,
+        lines=True,
+    ).redact
+    separator = RedactingFormatter.SEPARATOR.encode("utf-8")
+    total = 0
+    pending = b""
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        total += len(chunk)
+        cut = chunk.rfind(b"\n") + 1
+        if cut == 0:
+            end = chunk.rfind(separator)
+            cut = 0 if end < 0 else end + len(separator)
+        if cut == 0:
+            pending += chunk
+            continue
+        block = (pending + chunk[:cut]).decode("utf-8", "surrogateescape")
+        pending = chunk[cut:]
+        dest.write(redact(block).encode("utf-8", "surrogateescape"))
+    if pending:
+        line = redact(pending.decode("utf-8", "surrogateescape"))
+        dest.write(line.encode("utf-8", "surrogateescape"))
+    return total
+
+
+def redact_file(
+    input_path: str, output_path: str = None, chunk_size: int = CHUNK_SIZE
+) -> float:
+    """
+    Streams a log file through the PII redaction and reports
+    the throughput in MB/s on stderr
+    """
+    start = time.perf_counter()
+    with open(input_path, "rb") as src:
+        if output_path is None:
+            total = redact_stream(src, sys.stdout.buffer, chunk_size)
+            sys.stdout.flush()
+        else:
+            with open(output_path, "wb") as dest:
+                total = redact_stream(src, dest, chunk_size)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    throughput = total / elapsed / (1 << 20)
+    print(
+        "redacted {} bytes in {:.3f}s ({:.2f} MB/s)".format(
+            total, elapsed, throughput
+        ),
+        file=sys.stderr,
+    )
+    return throughput
 
 
 class RedactingFormatter(logging.Formatter):
-    """Redacting Formatter class"""
+    """
+    Redacting Formatter class. Records carrying a data mapping
+    (e.g. extra={"data": {...}}) have their PII keys masked
+    before formatting, and only their other pairs go through
+    the regex.
+    """
 
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
@@ -85,15 +619,65 @@ class RedactingFormatter(logging.Formatter):
     def __init__(self, fields: List[str]):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.redactor = get_redactor(
+            tuple(fields), self.SEPARATOR, self.REDACTION
+        )
+        self._masked = frozenset(fields)
+
+    def format_data(self, record: logging.LogRecord) -> str:
+        """
+        Formats a record carrying a data mapping, masking the PII
+        fields by key and scanning the free text message and the
+        other pairs
+        """
+        data = record.data
+        pairs = mask_row(
+            list(data.keys()), tuple(data.values()), self._masked,
+            self.redactor
+        )
+        text = self.redactor.redact(record.getMessage())
+        record = copy.copy(record)
+        record.msg = "{} {}".format(text, pairs) if text else pairs
+        record.args = None
+        return super(RedactingFormatter, self).format(record)
 
     def format(self, record: logging.LogRecord) -> str:
         """
         method that formats a LogRecord
         """
+        if isinstance(getattr(record, "data", None), Mapping) and \
+                record.exc_info is None and record.stack_info is None:
+            return self.format_data(record)
         msg = super(RedactingFormatter, self).format(record)
-        text = filter_datum(self.fields, self.REDACTION, msg, self.SEPARATOR)
-        return text
+        if isinstance(record, RedactedLogRecord):
+            return msg
+        return self.redactor.redact(msg)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Logs redacted user data.")
+    parser.add_argument(
+        "input", nargs="?", help="log file to redact instead of the db"
+    )
+    parser.add_argument("-o", "--output", help="redacted file (stdout)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--export", choices=EXPORT_FORMATS, help="dump users instead of logs"
+    )
+    cli_args = parser.parse_args()
+    if cli_args.export is not None:
+        if cli_args.output is None:
+            sys.stdout.flush()
+            dest = open(sys.stdout.fileno(), "w", buffering=CHUNK_SIZE,
+                        newline="", closefd=False)
+        else:
+            dest = open(cli_args.output, "w", buffering=CHUNK_SIZE,
+                        newline="")
+        with dest:
+            export_users(dest, cli_args.export, cli_args.batch_size)
+    elif cli_args.input is None:
+        main(cli_args.batch_size, workers=cli_args.workers)
+    else:
+        redact_file(cli_args.input, cli_args.output, cli_args.chunk_size)
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+Tests of filtered_logger.main against an sqlite3 users table
+"""
+import csv
+import io
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import unittest
+
+import filtered_logger
+
+
+USERS = [
+    ("bob", "bob@dylan.com", "555-0100", "123-45-6789", "hunter2",
+     "10.0.0.{}".format(i), "2019-11-14 06:14:24", "Mozilla/5.0")
+    for i in range(7)
+]
+
+
+class BatchCountingConnection:
+    """
+    sqlite3 connection whose cursors record the size of every
+    fetchmany call
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.batches = []
+
+    def cursor(self) -> "BatchCountingCursor":
+        return BatchCountingCursor(self.connection.cursor(), self.batches)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class BatchCountingCursor:
+    """
+    sqlite3 cursor that records the rows returned by fetchmany
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor, batches: list):
+        self.cursor = cursor
+        self.batches = batches
+
+    def execute(self, query: str) -> None:
+        self.cursor.execute(query)
+
+    def fetchmany(self, size: int) -> list:
+        rows = self.cursor.fetchmany(size)
+        self.batches.append(len(rows))
+        return rows
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class MainTest(unittest.TestCase):
+    """
+    main() reads the users table in batches and logs redacted rows
+    """
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute(
+            "CREATE TABLE users ({});".format(
+                ", ".join(filtered_logger.USER_COLUMNS)
+            )
+        )
+        self.connection.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?);", USERS
+        )
+        self.stream = io.StringIO()
+        self.logger = filtered_logger.get_logger()
+        self.handlers = self.logger.handlers
+        self.handler = logging.StreamHandler(self.stream)
+        self.handler.setFormatter(
+            filtered_logger.RedactingFormatter(filtered_logger.PII_FIELDS)
+        )
+        self.logger.handlers = [self.handler]
+
+    def tearDown(self):
+        self.logger.handlers = self.handlers
+        self.connection.close()
+
+    def lines(self) -> list:
+        return [
+            line.split(": ", 1)[1]
+            for line in self.stream.getvalue().splitlines()
+        ]
+
+    def test_redacted_lines(self):
+        connection = BatchCountingConnection(self.connection)
+        filtered_logger.main(batch_size=3, connection=connection)
+        lines = self.lines()
+        self.assertEqual(len(lines), len(USERS))
+        self.assertEqual(
+            lines[0],
+            "name=***; email=***; phone=***; ssn=***; password=***; "
+            "ip=10.0.0.0; last_login=2019-11-14 06:14:24; "
+            "user_agent=Mozilla/5.0;",
+        )
+        for line in lines:
+            for value in ("bob", "555-0100", "123-45-6789", "hunter2"):
+                self.assertNotIn(value, line)
+
+    def test_batches(self):
+        connection = BatchCountingConnection(self.connection)
+        filtered_logger.main(batch_size=3, connection=connection)
+        self.assertEqual(connection.batches, [3, 3, 1, 0])
+
+    def test_parallel_workers(self):
+        filtered_logger.main(
+            batch_size=2, connection=self.connection, workers=2
+        )
+        lines = self.lines()
+        self.assertEqual(len(lines), len(USERS))
+        self.assertEqual(
+            [line.split("; ")[5] for line in lines],
+            ["ip=10.0.0.{}".format(i) for i in range(len(USERS))],
+        )
+        self.assertNotIn("hunter2", self.stream.getvalue())
+
+    def test_connection_left_open(self):
+        filtered_logger.main(connection=self.connection)
+        count = self.connection.execute("SELECT COUNT(*) FROM users;")
+        self.assertEqual(count.fetchone(), (len(USERS),))
+
+
+class ExportUsersTest(unittest.TestCase):
+    """
+    export_users() writes the users table with the PII masked
+    """
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute(
+            "CREATE TABLE users ({});".format(
+                ", ".join(filtered_logger.USER_COLUMNS)
+            )
+        )
+        rows = USERS[:2] + [
+            USERS[2][:5] + values for values in (
+                ('1.2.3.4', '2019', 'Moz "x", y'),
+                (None, 3, "a\r\nb"),
+                ("x,y", 2.5, "plain%s"),
+            )
+        ]
+        self.connection.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows
+        )
+
+    def tearDown(self):
+        self.connection.close()
+
+    def expected(self) -> list:
+        cursor = self.connection.execute("SELECT * FROM users;")
+        return [("***",) * 5 + row[5:] for row in cursor]
+
+    def test_csv(self):
+        dest = io.StringIO(newline="")
+        count = filtered_logger.export_users(
+            dest, "csv", 2, self.connection
+        )
+        self.assertEqual(count, 5)
+        expected = io.StringIO(newline="")
+        writer = csv.writer(expected)
+        writer.writerow(filtered_logger.USER_COLUMNS)
+        writer.writerows(self.expected())
+        self.assertEqual(dest.getvalue(), expected.getvalue())
+
+    def test_jsonl(self):
+        dest = io.StringIO()
+        filtered_logger.export_users(dest, "jsonl", 2, self.connection)
+        lines = [json.loads(line) for line in dest.getvalue().splitlines()]
+        self.assertEqual(
+            [tuple(line.values()) for line in lines], self.expected()
+        )
+        self.assertEqual(
+            list(lines[0].keys()), list(filtered_logger.USER_COLUMNS)
+        )
+
+
+class RedactingFormatterTest(unittest.TestCase):
+    """
+    A data mapping is redacted like the same pairs in the message
+    """
+
+    def format(self, msg: str, data: dict = None) -> str:
+        formatter = filtered_logger.RedactingFormatter(
+            filtered_logger.PII_FIELDS
+        )
+        record = logging.LogRecord(
+            "user_data", logging.INFO, None, 0, msg, None, None
+        )
+        if data is not None:
+            record.data = data
+        return formatter.format(record).split(": ", 1)[1]
+
+    def test_data_like_message(self):
+        for data in (
+            {"name": "bob", "user_agent": "x; password=hunter2"},
+            {"username": "bob", "ip": "10.0.0.1"},
+            {"email": "a@b", "ssn": None, "last_login": 3},
+        ):
+            message = "{};".format("; ".join(
+                "{}={}".format(key, value) for key, value in data.items()
+            ))
+            self.assertEqual(self.format("", data), self.format(message))
+        self.assertEqual(
+            self.format("", {"user_agent": "x; password=hunter2"}),
+            "user_agent=x; password=***;",
+        )
+
+
+class RedactStreamTest(unittest.TestCase):
+    """
+    redact_stream() redacts every line like filter_datum, whatever
+    the chunk size
+    """
+
+    DATA = (
+        b"name=bob;email=bob@dylan.com;ip=10.0.0.1\n"
+        b"password=hunter2;user_agent=Mozilla/5.0\r\n"
+        b"password=se\rcret;ssn=123-45-6789;\r\n"
+        b"ip=10.0.0.2;last_login=2019-11-14\n"
+        b"\n"
+        b"phone=555-0100;name=b\xc3\xb6b"
+    )
+
+    def redact(self, data: bytes, chunk_size: int) -> bytes:
+        dest = io.BytesIO()
+        total = filtered_logger.redact_stream(
+            io.BytesIO(data), dest, chunk_size
+        )
+        self.assertEqual(total, len(data))
+        return dest.getvalue()
+
+    def expected(self, data: bytes) -> bytes:
+        lines = data.decode("utf-8").split("\n")
+        for i, line in enumerate(lines):
+            ending = "\r" if line.endswith("\r") and i < len(lines) - 1 \
+                else ""
+            lines[i] = filtered_logger.filter_datum(
+                filtered_logger.PII_FIELDS, "***",
+                line[:len(line) - len(ending)], ";"
+            ) + ending
+        return "\n".join(lines).encode("utf-8")
+
+    def test_chunk_sizes(self):
+        expected = self.expected(self.DATA)
+        self.assertIn(b"password=***;user_agent=Mozilla/5.0\r\n", expected)
+        self.assertIn(b"password=***;ssn=***;\r\n", expected)
+        self.assertTrue(expected.endswith(b"phone=***;name=***"))
+        for chunk_size in (1, 2, 3, 5, 8, 13, 64, len(self.DATA)):
+            self.assertEqual(self.redact(self.DATA, chunk_size), expected)
+
+    def test_lone_carriage_return(self):
+        self.assertEqual(
+            self.redact(b"password=se\rcret;x\n", 4), b"password=***;x\n"
+        )
+
+    def test_long_line_written_by_parts(self):
+        data = b"ip=10.0.0.1;" * 100 + b"password=hunter2;"
+        src = io.BytesIO(data)
+        dest = io.BytesIO()
+        written = []
+        read = src.read
+
+        def read_chunk(size: int) -> bytes:
+            written.append(len(dest.getvalue()))
+            return read(size)
+
+        src.read = read_chunk
+        filtered_logger.redact_stream(src, dest, 16)
+        self.assertEqual(dest.getvalue(), self.expected(data))
+        self.assertGreater(written[len(written) // 2], len(data) // 3)
+
+
+class BoundedQueueHandlerTest(unittest.TestCase):
+    """
+    A full queue blocks, drops the oldest or drops the newest
+    record depending on the overflow policy
+    """
+
+    def record(self, msg: str) -> logging.LogRecord:
+        return logging.LogRecord(
+            "user_data", logging.INFO, None, 0, msg, None, None
+        )
+
+    def queued(self, log_queue: queue.Queue) -> list:
+        messages = []
+        while not log_queue.empty():
+            messages.append(log_queue.get_nowait().msg)
+        return messages
+
+    def test_drop_newest(self):
+        log_queue = queue.Queue(2)
+        handler = filtered_logger.BoundedQueueHandler(
+            log_queue, "drop-newest"
+        )
+        for msg in ("a", "b", "c", "d"):
+            handler.handle(self.record(msg))
+        self.assertEqual(self.queued(log_queue), ["a", "b"])
+        self.assertEqual(handler.dropped, 2)
+
+    def test_drop_oldest(self):
+        log_queue = queue.Queue(2)
+        handler = filtered_logger.BoundedQueueHandler(
+            log_queue, "drop-oldest"
+        )
+        for msg in ("a", "b", "c", "d"):
+            handler.handle(self.record(msg))
+        self.assertEqual(self.queued(log_queue), ["c", "d"])
+        self.assertEqual(handler.dropped, 2)
+
+    def test_block(self):
+        log_queue = queue.Queue(2)
+        handler = filtered_logger.BoundedQueueHandler(log_queue, "block")
+        thread = threading.Thread(target=lambda: [
+            handler.handle(self.record(msg)) for msg in ("a", "b", "c")
+        ])
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(log_queue.get().msg, "a")
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.queued(log_queue), ["b", "c"])
+        self.assertEqual(handler.dropped, 0)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            filtered_logger.BoundedQueueHandler(queue.Queue(1), "drop-all")
+
+
+class AsynchronousLoggerTest(unittest.TestCase):
+    """
+    The asynchronous logger writes every queued record on
+    shutdown and is kept by calls that do not ask for a mode
+    """
+
+    def setUp(self):
+        self.logger = filtered_logger.get_logger(asynchronous=False)
+        self.handlers = list(self.logger.handlers)
+        self.stream = io.StringIO()
+        self.logger = filtered_logger.get_logger(
+            asynchronous=True, queue_size=4
+        )
+        filtered_logger._listener.handlers[0].setStream(self.stream)
+
+    def tearDown(self):
+        filtered_logger.shutdown_logger()
+        self.logger.handlers = self.handlers
+
+    def test_flush_on_shutdown(self):
+        for i in range(100):
+            self.logger.info("name=bob; ip=10.0.0.%s;", i)
+        filtered_logger.shutdown_logger()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(lines[-1].endswith("name=***; ip=10.0.0.99;"))
+        self.assertEqual(len(self.logger.handlers), 1)
+        self.assertIsInstance(self.logger.handlers[0], logging.StreamHandler)
+        self.logger.info("name=bob;")
+        self.assertTrue(self.stream.getvalue().endswith("name=***;\n"))
+
+    def test_kept_without_mode(self):
+        listener = filtered_logger._listener
+        self.assertIs(filtered_logger.get_logger(), self.logger)
+        self.assertIs(filtered_logger._listener, listener)
+        filtered_logger.get_logger(asynchronous=True)
+        self.assertIs(filtered_logger._listener, listener)
+        filtered_logger.get_logger(asynchronous=False)
+        self.assertIsNone(filtered_logger._listener)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """
+    ConnectionPool lends a bounded number of sqlite3 connections
+    and replaces the ones that fail the health check
+    """
+
+    def setUp(self):
+        self.connections = []
+        self.pool = filtered_logger.ConnectionPool(
+            size=2, connect=self.connect
+        )
+
+    def tearDown(self):
+        self.pool.close()
+        for connection in self.connections:
+            connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(":memory:")
+        self.connections.append(connection)
+        return connection
+
+    def test_checkout_and_return(self):
+        with self.pool.connection() as connection:
+            connection.execute("CREATE TABLE users (name);")
+            connection.execute("INSERT INTO users VALUES ('bob');")
+        with self.pool.connection() as again:
+            self.assertIs(again, connection)
+            count = again.execute("SELECT COUNT(*) FROM users;")
+            self.assertEqual(count.fetchone(), (0,))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_size_and_timeout(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertIsNot(first, second)
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire(timeout=0.05)
+        self.pool.release(first)
+        self.assertIs(self.pool.acquire(timeout=0.05), first)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_replaces_failed_connection(self):
+        with self.pool.connection() as connection:
+            pass
+        connection.close()
+        with self.pool.connection() as replacement:
+            self.assertIsNot(replacement, connection)
+            self.assertTrue(filtered_logger.is_alive(replacement))
+        self.assertEqual(len(self.connections), 2)
+
+    def test_positive_size(self):
+        with self.assertRaises(ValueError):
+            filtered_logger.ConnectionPool(size=0, connect=self.connect)
+
+
+def original_filter_datum(
+    fields: list, redaction: str, message: str, separator: str
+) -> str:
+    """
+    filter_datum as first written, a re.sub on the raw pattern
+    """
+    return re.sub(
+        r"(?P<field>{})=[^{}]*".format("|".join(fields), separator),
+        r"\g<field>={}".format(redaction),
+        message,
+    )
+
+
+class FilterDatumTest(unittest.TestCase):
+    """
+    filter_datum returns exactly what the original re.sub did
+    """
+
+    MESSAGES = (
+        "",
+        "ip=10.0.0.1;user_agent=Mozilla/5.0;",
+        "username=bob;e-mail=bob@dylan.com;",
+        "name=bob;email=bob@dylan.com;password=hunter2;ip=1;",
+        "xname=bob;name=;password=a=b;",
+        "a.b=1;axb=2;x+=3;xx=4;(y)=5;y=6;",
+        "name=bob|email=a@b|ip=1|a.b=2",
+        "name=b\u00f6b;phone=555\n0100;",
+    )
+    FIELDS = (
+        ["name", "email", "phone", "ssn", "password"],
+        ["a.b", "x+", "(y)"],
+        ["e-mail"],
+        ["password"],
+    )
+
+    def test_like_original(self):
+        for fields in self.FIELDS:
+            for separator in (";", "|"):
+                for message in self.MESSAGES:
+                    self.assertEqual(
+                        filtered_logger.filter_datum(
+                            fields, "xxx", message, separator
+                        ),
+                        original_filter_datum(
+                            fields, "xxx", message, separator
+                        ),
+                        (fields, separator, message),
+                    )
+
+    def test_no_pii_unchanged(self):
+        message = "ip=10.0.0.1;user_agent=Mozilla/5.0;"
+        self.assertIs(
+            filtered_logger.filter_datum(
+                ["name", "password"], "xxx", message, ";"
+            ),
+            message,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ from api.v1.views import app_views
 from flask import Flask, jsonify, abort, request
 from flask_cors import CORS, cross_origin
 import os
+from models.base import refresh
 from api.v1.auth.auth import Auth
 from api.v1.auth.basic_auth import BasicAuth
 from api.v1.auth.session_auth import SessionAuth
@@ -34,7 +35,9 @@ if auth_type == "session_db_auth":
 
 @app.before_request
 def before_request_func():
-    """Authenticates a user before processing a request."""
+    """Picks up the changes of other workers and authenticates a user
+    before processing a request."""
+    refresh()
     if auth:
         excluded_paths = [
             "/api/v1/status/",
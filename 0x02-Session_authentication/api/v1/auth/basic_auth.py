@@ -105,13 +105,13 @@ class BasicAuth(Auth):
         """
         if type(user_email) == str and type(user_pwd) == str:
             try:
-                users = User.search({"email": user_email})
+                user = User.query({"email": user_email}).first()
             except Exception:
                 return None
-            if len(users) <= 0:
+            if user is None:
                 return None
-            if users[0].is_valid_password(user_pwd):
-                return users[0]
+            if user.is_valid_password(user_pwd):
+                return user
         return None
 
     def current_user(self, request=None) -> TypeVar("User"):
@@ -29,26 +29,26 @@ class SessionDBAuth(SessionExpAuth):
         a given session id.
         """
         try:
-            sessions = UserSession.search({"session_id": session_id})
+            session = UserSession.query({"session_id": session_id}).first()
         except Exception:
             return None
-        if len(sessions) <= 0:
+        if session is None:
             return None
         cur_time = datetime.now()
         time_span = timedelta(seconds=self.session_duration)
-        exp_time = sessions[0].created_at + time_span
+        exp_time = session.created_at + time_span
         if exp_time < cur_time:
             return None
-        return sessions[0].user_id
+        return session.user_id
 
     def destroy_session(self, request=None) -> bool:
         """Destroys an authenticated session."""
         session_id = self.session_cookie(request)
         try:
-            sessions = UserSession.search({"session_id": session_id})
+            session = UserSession.query({"session_id": session_id}).first()
         except Exception:
             return False
-        if len(sessions) <= 0:
+        if session is None:
             return False
-        sessions[0].remove()
+        session.remove()
         return True
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """ Module of Index views
 """
+import os
+from datetime import datetime, timedelta
 from flask import jsonify, abort
 from api.v1.views import app_views
 
@@ -37,10 +39,28 @@ def status() -> str:
 def stats() -> str:
     """GET /api/v1/stats
     Return:
-      - the number of each objects
+      - the number of each objects, of sessions still active and
+        expired after SESSION_DURATION seconds, and of users created
+        each day
     """
     from models.user import User
+    from models.user_session import UserSession
+
+    try:
+        session_duration = int(os.getenv("SESSION_DURATION", "0"))
+    except Exception:
+        session_duration = 0
+    since = None
+    if session_duration > 0:
+        since = datetime.utcnow() - timedelta(seconds=session_duration)
+    users = User.stats()
+    sessions = UserSession.stats(since)
+    active_sessions = sessions.get("since", sessions["count"])
 
     stats = {}
-    stats["users"] = User.count()
+    stats["users"] = users["count"]
+    stats["user_sessions"] = sessions["count"]
+    stats["active_sessions"] = active_sessions
+    stats["expired_sessions"] = sessions["count"] - active_sessions
+    stats["users_per_day"] = users["per_day"]
     return jsonify(stats)
@@ -2,18 +2,89 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import abort, jsonify, request, Response
+from typing import Iterator
 from models.user import User
+import json
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def stream_users(fmt: str) -> Iterator[str]:
+    """ Yield all User objects JSON represented, as one JSON array or
+    one per line, by ascending ID. They are read STREAM_CHUNK_SIZE at a
+    time, each chunk starting after the last ID of the previous one.
+    """
+    opening = "["
+    cursor = None
+    while True:
+        query = User.query().order_by('id')
+        if cursor is not None:
+            query = query.where('id', '>', cursor)
+        users = query.limit(STREAM_CHUNK_SIZE).all()
+        chunk = []
+        for user in users:
+            if fmt == "ndjson":
+                chunk.append(json.dumps(user.to_json()) + "\n")
+            else:
+                chunk.append(opening + json.dumps(user.to_json()))
+                opening = ","
+        if len(users) < STREAM_CHUNK_SIZE:
+            break
+        yield "".join(chunk)
+        cursor = users[-1].id
+    if fmt == "json":
+        chunk.append("[]" if opening == "[" else "]")
+    yield "".join(chunk)
 
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters:
+      - limit (optional): number of users per page, by ascending ID
+      - cursor (optional): next_cursor of the previous page
+      - stream (optional): json or ndjson to stream all users, by
+        ascending ID
     Return:
       - list of all User objects JSON represented
+      - with limit or cursor, the page of User objects JSON represented
+        in users, and the cursor of the next page, or null after the
+        last one, in next_cursor
+      - 400 if limit or stream is invalid
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    stream = request.args.get('stream')
+    if stream is not None:
+        if stream not in STREAM_FORMATS:
+            return jsonify({'error': "Wrong stream format"}), 400
+        return Response(stream_users(stream), mimetype=STREAM_FORMATS[stream])
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        all_users = [user.to_json() for user in User.all()]
+        return jsonify(all_users)
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        limit = 0
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return jsonify({'error': "Wrong limit"}), 400
+    query = User.query().order_by('id')
+    if cursor:
+        query = query.where('id', '>', cursor)
+    users = query.limit(limit + 1).all()
+    next_cursor = users[limit - 1].id if len(users) > limit else None
+    return jsonify({
+        'users': [user.to_json() for user in users[:limit]],
+        'next_cursor': next_cursor,
+    })
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+""" Benchmarks of the models storage
+
+    ./bench_models.py startup --count 1000000
+    ./bench_models.py memory --count 1000000
+    ./bench_models.py stress --threads 16 --count 2000
+    ./bench_models.py snapshot --count 100000
+    ./bench_models.py snapshot --count 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+from models import base
+from models.base import DATA, INDEXES
+from models.reshard import reshard
+from models.user import User
+
+
+SNAPSHOT_FORMATS = (
+    ("json", "none"),
+    ("binary", "none"),
+    ("binary", "zlib"),
+)
+
+
+def make_users_file(count: int):
+    """ Write a .db_User.json file of count users in the current directory
+    """
+    objs_json = {}
+    for i in range(count):
+        obj_id = str(uuid.uuid4())
+        objs_json[obj_id] = {
+            "id": obj_id,
+            "created_at": "2017-09-28T21:05:12",
+            "updated_at": "2017-09-28T21:05:12",
+            "email": "user{}@example.com".format(i),
+            "_password": "{:064x}".format(i),
+            "first_name": "First{}".format(i),
+            "last_name": "Last{}".format(i),
+        }
+    with open(".db_User.json", "w") as f:
+        json.dump(objs_json, f)
+
+
+def load_eagerly():
+    """ Load the users the way load_from_file did before bulk hydration:
+    through the constructor, with both timestamps parsed up front
+    """
+    with open(".db_User.json", "r") as f:
+        objs_json = json.load(f)
+    DATA["User"] = {}
+    for obj_id, obj_json in objs_json.items():
+        obj = User(**obj_json)
+        obj.created_at, obj.updated_at
+        DATA["User"][obj_id] = obj
+
+
+def bench_startup(count: int):
+    """ Compare the eager and bulk loading of count users
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            make_users_file(count)
+            for name, load in (("constructor", load_eagerly),
+                               ("load_from_file", User.load_from_file)):
+                DATA.pop("User", None)
+                start = time.perf_counter()
+                load()
+                elapsed = time.perf_counter() - start
+                print("{:<16} {:>8.2f}s {:>12.0f} objects/s".format(
+                    name, elapsed, count / elapsed
+                ))
+        finally:
+            os.chdir(cwd)
+
+
+def bench_snapshot(count: int):
+    """ Compare the load and save times and file sizes of count users
+    in each snapshot format, spread over MODELS_SHARDS shards
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            make_users_file(count)
+            shards, base.SHARDS = base.SHARDS, 1
+            reshard([User], shards)
+            print("{:<14} {:>8} {:>8} {:>10}".format(
+                "format", "load", "save", "size"
+            ))
+            for fmt, compression in SNAPSHOT_FORMATS:
+                base.SNAPSHOT_FORMAT = fmt
+                base.SNAPSHOT_COMPRESSION = compression
+                User.save_to_file()
+                start = time.perf_counter()
+                User.load_from_file()
+                load = time.perf_counter() - start
+                start = time.perf_counter()
+                User.save_to_file()
+                save = time.perf_counter() - start
+                print("{:<14} {:>7.2f}s {:>7.2f}s {:>9.1f}M".format(
+                    "{}/{}".format(fmt, compression), load, save,
+                    sum(os.path.getsize(User._snapshot_path(shard))
+                        for shard in range(base.SHARDS)) / 1e6
+                ))
+        finally:
+            os.chdir(cwd)
+
+
+class DictUser():
+    """ User as it was stored before __slots__: in a per-instance dict
+    """
+
+    def __init__(self, **kwargs):
+        """ Set the attributes of a User
+        """
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+def bench_memory(count: int):
+    """ Report the bytes per object of dict and slots based users
+    """
+    states = [
+        {
+            "id": str(uuid.uuid4()),
+            "created_at": "2017-09-28T21:05:12",
+            "updated_at": "2017-09-28T21:05:12",
+            "email": "user{}@example.com".format(i),
+            "_password": "{:064x}".format(i),
+            "first_name": "First{}".format(i),
+            "last_name": "Last{}".format(i),
+        }
+        for i in range(count)
+    ]
+    for name, build in (("__dict__", lambda state: DictUser(**state)),
+                        ("__slots__", User._hydrate)):
+        tracemalloc.start()
+        objs = [build(state) for state in states]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:<10} {:>8.1f} bytes/object".format(name, size / count))
+        del objs
+
+
+def stress_worker(count: int, seed: int, errors: list):
+    """ Run count random saves, removes and searches
+    """
+    rand = random.Random(seed)
+    mine = []
+    try:
+        for i in range(count):
+            op = rand.random()
+            if op < 0.4 or not mine:
+                user = User()
+                user.email = "user{}@example.com".format(rand.randrange(50))
+                user.save()
+                mine.append(user)
+            elif op < 0.55:
+                mine.pop(rand.randrange(len(mine))).remove()
+            elif op < 0.65:
+                user = rand.choice(mine)
+                user.email = "user{}@example.com".format(rand.randrange(50))
+                user.save()
+            elif op < 0.95:
+                User.search({
+                    "email": "user{}@example.com".format(rand.randrange(50))
+                })
+            else:
+                User.all()
+    except Exception as e:
+        errors.append(repr(e))
+
+
+def check_store() -> list:
+    """ Compare the objects in memory with their indexes and the file
+    """
+    errors = []
+    users = DATA["User"]
+    entries, keys = INDEXES["User"]["email"]
+    indexed = sum(len(matches) for matches in entries.values())
+    if indexed != len(users) or len(keys) != len(users):
+        errors.append("{} users but {} indexed".format(len(users), indexed))
+    for obj_id, user in users.items():
+        if entries.get(user.email, {}).get(obj_id) is not user:
+            errors.append("{} missing from the email index".format(obj_id))
+    stored = {obj_id: user.to_json(True) for obj_id, user in users.items()}
+    User.load_from_file()
+    loaded = {obj_id: user.to_json(True) for obj_id, user in
+              DATA["User"].items()}
+    if loaded != stored:
+        errors.append("file differs from memory")
+    return errors
+
+
+def stress(threads: int, count: int) -> bool:
+    """ Hammer the User store from many threads, then check it
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            User.load_from_file()
+            errors = []
+            workers = [
+                threading.Thread(target=stress_worker,
+                                 args=(count, seed, errors))
+                for seed in range(threads)
+            ]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            errors += check_store()
+        finally:
+            os.chdir(cwd)
+    print("{} threads, {:.0f} ops/s, {} users, {} errors".format(
+        threads, threads * count / elapsed, len(DATA["User"]), len(errors)
+    ))
+    for error in errors[:10]:
+        print("  " + error)
+    return not errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Models storage benchmarks")
+    parser.add_argument("bench", choices=(
+        "startup", "memory", "stress", "snapshot"
+    ))
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+    if args.bench == "startup":
+        bench_startup(args.count)
+    elif args.bench == "memory":
+        bench_memory(args.count)
+    elif args.bench == "snapshot":
+        bench_snapshot(args.count)
+    elif not stress(args.threads, args.count):
+        sys.exit(1)
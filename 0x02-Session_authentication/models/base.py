@@ -1,40 +1,401 @@
 #!/usr/bin/env python3
 """ Base module
+
+Objects are persisted in .db_<Class>.json. With the MODELS_STORAGE_MODE
+environment variable set to "journal", save and remove append one
+record to .db_<Class>.journal instead of rewriting that file, and the
+journal is compacted into it in the background once it grows past
+MODELS_JOURNAL_COMPACT_SIZE bytes.
+
+MODELS_STORAGE_ENGINE=sqlite replaces the JSON files with the engine
+in models.engine.sqlite_storage, on the MODELS_SQLITE_PATH database.
+The rest of this section only applies to the JSON files.
+
+MODELS_SNAPSHOT_FORMAT=binary stores the objects in the binary format
+of models.snapshot, in .db_<Class>.bin, compressed according to
+MODELS_SNAPSHOT_COMPRESSION. The journal stays in JSON.
+
+With MODELS_SHARDS=N above 1, the objects of each class are spread by
+a hash of their id over N shards, each with its own files, named
+.db_<Class>.<shard>.json and so on: a mutation only writes the files
+of its shard, and the shards are read in parallel on load. The objects
+are moved to another number of shards with models.reshard.
+
+Writes are deferred inside unit_of_work() blocks, and while the
+background flusher runs (started by MODELS_FLUSH_INTERVAL_MS or
+start_flusher()): they are then written once per class by flush().
+
+Several processes can share the files, each refresh() picking up the
+changes of the others: in journal mode, by applying the records they
+appended since the last read, and in snapshot mode by replacing the
+objects that differ once the file changed. Processes that write
+concurrently should use journal mode, as a snapshot written by one
+overwrites the changes of the others it did not see yet.
 """
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from itertools import islice
+from threading import get_ident
+from typing import TypeVar, List, Iterable, Iterator
+from os import getenv, path
+import atexit
+import fcntl
 import json
+import os
+import threading
 import uuid
+import zlib
+
+from models import journal, snapshot
+from models.query import Query
+from models.sorted_keys import SortedKeys
+from models.stats import Stats
 
 
-TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+TIMESTAMP_FORMAT = snapshot.TIMESTAMP_FORMAT
+TIMESTAMP_ATTRIBUTES = snapshot.TIMESTAMP_ATTRIBUTES
+STORAGE_MODE = getenv("MODELS_STORAGE_MODE", "snapshot")
+SNAPSHOT_FORMAT = getenv("MODELS_SNAPSHOT_FORMAT", "json")
+SNAPSHOT_COMPRESSION = getenv("MODELS_SNAPSHOT_COMPRESSION", "none")
+SHARDS = int(getenv("MODELS_SHARDS", "1"))
+LOAD_WORKERS = os.cpu_count() or 1
+JOURNAL_COMPACT_SIZE = int(getenv("MODELS_JOURNAL_COMPACT_SIZE", "4194304"))
+SCAN_CHUNK_SIZE = 1000
+STORAGE_LOCK = threading.RLock()
 DATA = {}
+INDEXES = {}
+IDS = {}
+STATS = {}
+_PENDING = {}
+_UNIT_OF_WORK = threading.local()
+_FLUSHER = None
+_SLOTS = {}
+_LOCKS = {}
+_SYNC = {}
+_LOCK_FILES = {}
+_SHARD_OBJECTS = {}
+ENGINE = None
+if getenv("MODELS_STORAGE_ENGINE", "json") == "sqlite":
+    from models.engine.sqlite_storage import SQLiteStorage
+
+    ENGINE = SQLiteStorage(getenv("MODELS_SQLITE_PATH", ".db.sqlite3"))
+
+
+def _stat_key(file_path: str) -> tuple:
+    """ (inode, size, modification time) of a file, None if it is
+    missing: a change means that it was written or replaced
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _shard_of(obj_id: str) -> int:
+    """ Shard of the object with this id, the same in every process
+    """
+    return zlib.crc32(obj_id.encode('utf-8')) % SHARDS
+
+
+class ReadWriteLock():
+    """ Lock shared by readers and held alone by a writer. Writers
+    waiting block new readers, and the writing thread may take the
+    lock again, for reading or writing.
+    """
+
+    def __init__(self):
+        """ Initialize an unlocked lock
+        """
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """ Hold the lock shared for the enclosed block
+        """
+        with self._cond:
+            owned = self._writer == get_ident()
+            if not owned:
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if not owned:
+                with self._cond:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """ Hold the lock alone for the enclosed block
+        """
+        me = get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class LazyTimestamp():
+    """ Descriptor around a timestamp slot that parses a serialized
+    value, or converts seconds since the epoch, the first time it is
+    read
+    """
+
+    def __init__(self, slot):
+        """ Wrap the member descriptor of the slot
+        """
+        self.slot = slot
+
+    def __get__(self, obj, owner=None):
+        """ Return the timestamp as a datetime
+        """
+        if obj is None:
+            return self
+        value = self.slot.__get__(obj, owner)
+        if type(value) is str:
+            value = datetime.strptime(value, TIMESTAMP_FORMAT)
+            self.slot.__set__(obj, value)
+        elif type(value) is int:
+            value = snapshot.int_to_datetime(value)
+            self.slot.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        """ Store a datetime or a serialized timestamp
+        """
+        self.slot.__set__(obj, value)
 
 
 class Base():
     """ Base class
+
+    Instances keep their attributes in __slots__: subclasses declare
+    theirs the same way to stay compact, or get a __dict__ otherwise.
+
+    Subclasses list the attributes searched by equality in
+    indexed_attributes to get a hash index on each of them.
+
+    The objects of each class are guarded by a ReadWriteLock, and all
+    mutations and writes to files are serialized by STORAGE_LOCK.
     """
 
+    __slots__ = ('id', 'created_at', 'updated_at', '__json')
+    indexed_attributes = ()
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+            with self.__class__._lock().write():
+                if DATA.get(s_class) is None:
+                    DATA[s_class] = {}
+                    self.__class__._reset_indexes()
+                    self.__class__._bulk_index()
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
+        if kwargs.get('id') is not None:
+            self.id = kwargs.get('id')
+        else:
+            self.id = str(uuid.uuid4())
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = kwargs.get('created_at')
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = kwargs.get('updated_at')
         else:
             self.updated_at = datetime.utcnow()
 
+    @classmethod
+    def _lock(cls) -> ReadWriteLock:
+        """ Lock of the objects of the class
+        """
+        lock = _LOCKS.get(cls.__name__)
+        if lock is None:
+            lock = _LOCKS.setdefault(cls.__name__, ReadWriteLock())
+        return lock
+
+    @classmethod
+    def _slots(cls) -> List[tuple]:
+        """ (name, member descriptor) of every slot of the class
+        """
+        slots = _SLOTS.get(cls)
+        if slots is None:
+            slots = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name.startswith('__'):
+                        continue
+                    slot = klass.__dict__[name]
+                    slots.append((name, getattr(slot, 'slot', slot)))
+            _SLOTS[cls] = slots
+        return slots
+
+    def _state(self) -> Iterator[tuple]:
+        """ (name, stored value) of every attribute that is set,
+        timestamps in the form they were stored
+        """
+        for name, slot in self._slots():
+            try:
+                yield name, slot.__get__(self)
+            except AttributeError:
+                continue
+        yield from getattr(self, '__dict__', {}).items()
+
+    @classmethod
+    def _hydrate(cls, obj_json: dict) -> TypeVar('Base'):
+        """ Build an object from its serialized form without running
+        __init__, leaving the attributes it lacks to None
+        """
+        obj = cls.__new__(cls)
+        for name, slot in cls._slots():
+            slot.__set__(obj, obj_json.get(name))
+        if hasattr(obj, '__dict__'):
+            for name, value in obj_json.items():
+                if name not in obj.__dict__ and not hasattr(cls, name):
+                    obj.__dict__[name] = value
+        if obj.id is None:
+            obj.id = str(uuid.uuid4())
+        if obj_json.get('created_at') is None:
+            obj.created_at = datetime.utcnow()
+        if obj_json.get('updated_at') is None:
+            obj.updated_at = datetime.utcnow()
+        return obj
+
+    @classmethod
+    def _hydrate_row(cls, row: tuple) -> TypeVar('Base'):
+        """ Build an object from a row of the binary snapshot of the
+        class, keeping the row as its memoized one
+        """
+        obj = cls.__new__(cls)
+        object.__setattr__(obj, '_Base__json', row)
+        for (name, slot), value in zip(cls._slots(), row):
+            slot.__set__(obj, value)
+        if cls.__dictoffset__ and row[-1]:
+            obj.__dict__.update(row[-1])
+        if row[0] is None:
+            obj.id = str(uuid.uuid4())
+        if row[1] is None:
+            obj.created_at = datetime.utcnow()
+        if row[2] is None:
+            obj.updated_at = datetime.utcnow()
+        return obj
+
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, dropping its memoized JSON text or binary
+        row and keeping the indexes of stored objects
+        """
+        object.__setattr__(self, '_Base__json', None)
+        if name in self.indexed_attributes and self._is_stored():
+            with self._lock().write():
+                if self._is_stored():
+                    self._unindex(replaced=True)
+                    super().__setattr__(name, value)
+                    self._index()
+                    return
+        super().__setattr__(name, value)
+
+    def _is_stored(self) -> bool:
+        """ Check if this very object is the stored one for its id
+        """
+        objs = DATA.get(self.__class__.__name__, {})
+        return objs.get(getattr(self, 'id', None)) is self
+
+    @classmethod
+    def _reset_indexes(cls):
+        """ Drop all index entries of the class, and its objects by shard.
+        Its ids in order and its stats are left out until _bulk_index().
+        """
+        INDEXES[cls.__name__] = {
+            attr: ({}, {}) for attr in cls.indexed_attributes
+        }
+        IDS[cls.__name__] = None
+        STATS[cls.__name__] = None
+        if SHARDS > 1:
+            _SHARD_OBJECTS[cls.__name__] = [{} for _ in range(SHARDS)]
+
+    @classmethod
+    def _bulk_index(cls):
+        """ Sort the ids of the objects of the class and count them again,
+        in one pass
+        """
+        IDS[cls.__name__] = SortedKeys(DATA[cls.__name__])
+        STATS[cls.__name__] = Stats(
+            (obj.id, obj._created_seconds())
+            for obj in DATA[cls.__name__].values()
+        )
+
+    def _created_seconds(self) -> int:
+        """ Creation time in seconds since the epoch, read without
+        parsing the stored timestamp into a datetime
+        """
+        return snapshot.timestamp_to_int(Base.created_at.slot.__get__(self))
+
+    def _index(self):
+        """ Add the object to the indexes, ids and stats of its class, and
+        its shard
+        """
+        s_class = self.__class__.__name__
+        if SHARDS > 1:
+            _SHARD_OBJECTS[s_class][_shard_of(self.id)][self.id] = self
+        ids = IDS.get(s_class)
+        if ids is not None:
+            ids.add(self.id)
+        stats = STATS.get(s_class)
+        if stats is not None:
+            stats.add(self.id, self._created_seconds())
+        for attr, (entries, keys) in INDEXES[s_class].items():
+            value = getattr(self, attr, None)
+            try:
+                entries.setdefault(value, {})[self.id] = self
+            except TypeError:
+                continue
+            keys[self.id] = value
+
+    def _unindex(self, replaced: bool = False):
+        """ Remove the object from the indexes, ids and stats of its class,
+        and its shard. When it is replaced by an object with the same id,
+        which _index() then adds, its id and stats are left in place.
+        """
+        s_class = self.__class__.__name__
+        if SHARDS > 1:
+            _SHARD_OBJECTS[s_class][_shard_of(self.id)].pop(self.id, None)
+        ids = IDS.get(s_class)
+        if ids is not None and not replaced:
+            ids.discard(self.id)
+        stats = STATS.get(s_class)
+        if stats is not None and not replaced:
+            stats.discard(self.id)
+        for attr, (entries, keys) in INDEXES[s_class].items():
+            if self.id not in keys:
+                continue
+            value = keys.pop(self.id)
+            matches = entries.get(value, {})
+            matches.pop(self.id, None)
+            if len(matches) == 0:
+                entries.pop(value, None)
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -44,69 +405,538 @@ class Base():
             return False
         return (self.id == other.id)
 
-    def to_json(self, for_serialization: bool = False) -> dict:
-        """ Convert the object a JSON dictionary
+    def _serialized(self) -> dict:
+        """ Serialized dict of the attributes, decoded from the memoized
+        JSON text when there is one
         """
+        memo = getattr(self, '_Base__json', None)
+        if type(memo) is str:
+            return json.loads(memo)
         result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
+        for key, value in self._state():
             if type(value) is datetime:
                 result[key] = value.strftime(TIMESTAMP_FORMAT)
+            elif type(value) is int and key in TIMESTAMP_ATTRIBUTES:
+                value = snapshot.int_to_datetime(value)
+                result[key] = value.strftime(TIMESTAMP_FORMAT)
             else:
                 result[key] = value
         return result
 
+    def to_json(self, for_serialization: bool = False) -> dict:
+        """ Convert the object a JSON dictionary
+        """
+        result = self._serialized()
+        if for_serialization:
+            return result
+        return {k: v for k, v in result.items() if k[0] != '_'}
+
+    def _encoded(self) -> str:
+        """ Memoized JSON text of to_json(True)
+        """
+        memo = getattr(self, '_Base__json', None)
+        if type(memo) is not str:
+            memo = json.dumps(self._serialized())
+            object.__setattr__(self, '_Base__json', memo)
+        return memo
+
+    @classmethod
+    def _fields(cls) -> List[str]:
+        """ Fields of the rows of the binary snapshot of the class
+        """
+        fields = [name for name, _ in cls._slots()]
+        if cls.__dictoffset__:
+            fields.append(snapshot.EXTRAS)
+        return fields
+
+    def _row(self) -> tuple:
+        """ Memoized values of the fields of the class, timestamps as
+        seconds since the epoch
+        """
+        memo = getattr(self, '_Base__json', None)
+        if type(memo) is tuple:
+            return memo
+        row = []
+        for name, slot in self._slots():
+            try:
+                value = slot.__get__(self)
+            except AttributeError:
+                value = None
+            if name in TIMESTAMP_ATTRIBUTES and value is not None:
+                value = snapshot.timestamp_to_int(value)
+            row.append(value)
+        if hasattr(self, '__dict__'):
+            row.append(dict(self.__dict__) or None)
+        row = tuple(row)
+        object.__setattr__(self, '_Base__json', row)
+        return row
+
+    def _matches(self, obj_json) -> bool:
+        """ Check if a serialized dict, with timestamps possibly in
+        seconds since the epoch, or a binary row is the one of the object
+        """
+        if type(obj_json) is tuple:
+            return self._row() == obj_json
+        for name in TIMESTAMP_ATTRIBUTES:
+            if type(obj_json.get(name)) is int:
+                obj_json = dict(obj_json)
+                value = snapshot.int_to_datetime(obj_json[name])
+                obj_json[name] = value.strftime(TIMESTAMP_FORMAT)
+        return self._serialized() == obj_json
+
+    @classmethod
+    def _file_prefix(cls, shard: int) -> str:
+        """ Common prefix of the files of a shard of the class
+        """
+        if SHARDS == 1:
+            return ".db_{}".format(cls.__name__)
+        return ".db_{}.{}".format(cls.__name__, shard)
+
+    @classmethod
+    def _snapshot_path(cls, shard: int = 0) -> str:
+        """ File of the objects of a shard in SNAPSHOT_FORMAT
+        """
+        if SNAPSHOT_FORMAT == "binary":
+            return cls._file_prefix(shard) + ".bin"
+        return cls._file_prefix(shard) + ".json"
+
+    @classmethod
+    def _journal_path(cls, shard: int = 0) -> str:
+        """ Journal of the mutations of a shard
+        """
+        return cls._file_prefix(shard) + ".journal"
+
+    @classmethod
+    def _lock_path(cls, shard: int = 0) -> str:
+        """ Lock file of the journal of a shard
+        """
+        return path.abspath(cls._file_prefix(shard) + ".lock")
+
+    @classmethod
+    def _shard_objects(cls, shard: int) -> dict:
+        """ Objects of a shard, by id
+        """
+        if SHARDS == 1:
+            return DATA[cls.__name__]
+        return _SHARD_OBJECTS[cls.__name__][shard]
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from storage
+        """
+        if ENGINE is not None:
+            ENGINE.load(cls)
+            return
+        cls._load_json()
+
+    @classmethod
+    def _load_json(cls):
+        """ Load all objects from file, then replay the journal. The
+        files of the shards are read in parallel.
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        flush()
+        with STORAGE_LOCK, cls._lock().write(), ExitStack() as stack:
+            for shard in range(SHARDS):
+                stack.enter_context(cls._journal_lock(shard, True))
+            if SHARDS == 1:
+                results = [cls._read_files(0, repair=True)]
+            else:
+                with ThreadPoolExecutor(min(SHARDS, LOAD_WORKERS)) as pool:
+                    results = list(pool.map(
+                        lambda shard: cls._read_files(shard, repair=True),
+                        range(SHARDS)
+                    ))
+            DATA[s_class] = {}
+            cls._reset_indexes()
+            for shard, (objs_json, replayed) in enumerate(results):
+                cls._merge(objs_json, shard)
+            cls._bulk_index()
+            for shard, (objs_json, replayed) in enumerate(results):
+                journal_path = cls._journal_path(shard)
+                if STORAGE_MODE != "journal" and replayed:
+                    cls._write_snapshot(shard, cls._snapshot(shard))
+                    cls._remove_journals(shard)
+                elif path.exists(journal_path + ".old"):
+                    cls._write_snapshot(shard, cls._snapshot(shard))
+                    os.remove(journal_path + ".old")
+
+    @classmethod
+    def _read_files(cls, shard: int, repair: bool = False) -> tuple:
+        """ Serialized objects of the file of a shard with its journals
+        replayed over them, and whether they held records. Notes how far
+        the files were read for refresh().
+        """
+        file_path = cls._snapshot_path(shard)
+        journal_path = cls._journal_path(shard)
+        sync = {
+            "snapshot": _stat_key(file_path),
+            "journal": _stat_key(journal_path),
+            "generation": journal.generation(journal_path),
+        }
+        objs_json = {}
+        if path.exists(file_path):
+            objs_json = cls._load_snapshot(file_path)
+        replayed = False
+        for file_name in (journal_path + ".old", journal_path):
+            records, sync["offset"] = journal.read(file_name, 0, repair)
+            for record in records:
+                if record["op"] == "save":
+                    objs_json[record["id"]] = record["obj"]
+                elif record["op"] == "remove":
+                    objs_json.pop(record["id"], None)
+                replayed = True
+        _SYNC.setdefault(cls, {})[shard] = sync
+        return objs_json, replayed
+
+    @classmethod
+    def _load_snapshot(cls, file_path: str) -> dict:
+        """ Serialized objects of a snapshot file, by id: the binary
+        rows are kept as they are when their fields are the ones of the
+        class, and turned into dicts otherwise
+        """
+        if SNAPSHOT_FORMAT != "binary":
+            with open(file_path, 'r') as f:
+                return json.load(f)
+        with open(file_path, 'rb') as f:
+            fields, rows = snapshot.load(f)
+        if fields == cls._fields():
+            return {row[0]: row for row in rows}
+        row_to_dict = snapshot.row_to_dict
+        position = fields.index('id')
+        return {row[position]: row_to_dict(fields, row) for row in rows}
+
+    @classmethod
+    def _merge(cls, objs_json: dict, shard: int):
+        """ Make the objects of a shard match their serialized dicts or
+        binary rows, replacing only the ones that differ
+        """
+        objs = DATA[cls.__name__]
+        for obj_id in [obj_id for obj_id in cls._shard_objects(shard)
+                       if obj_id not in objs_json]:
+            objs.pop(obj_id)._unindex()
+        hydrate, hydrate_row = cls._hydrate, cls._hydrate_row
+        for obj_id, obj_json in objs_json.items():
+            stored = objs.get(obj_id)
+            if stored is not None:
+                if stored._matches(obj_json):
+                    continue
+                stored._unindex(replaced=True)
+            if type(obj_json) is tuple:
+                obj = hydrate_row(obj_json)
+            else:
+                obj = hydrate(obj_json)
+            objs[obj_id] = obj
+            obj._index()
+
+    @classmethod
+    def _apply(cls, record: dict):
+        """ Apply one journal record to the objects in memory
+        """
+        s_class = cls.__name__
+        if record["op"] not in ("save", "remove"):
             return
+        stored = DATA[s_class].get(record["id"])
+        if stored is not None:
+            if record["op"] == "save" and stored._matches(record["obj"]):
+                return
+            stored._unindex(replaced=record["op"] == "save")
+            del DATA[s_class][record["id"]]
+        if record["op"] == "save":
+            obj = cls._hydrate(record["obj"])
+            DATA[s_class][obj.id] = obj
+            obj._index()
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def refresh(cls):
+        """ Apply the changes other processes wrote since the objects
+        were loaded or last refreshed. A stat() per shard tells which
+        changed; in journal mode, the records appended to those since
+        the last one read are applied, and in snapshot mode the objects
+        of their files that differ from the ones in memory are replaced.
+        """
+        syncs = _SYNC.get(cls)
+        if ENGINE is not None or syncs is None:
+            return
+        changed = []
+        for shard, sync in syncs.items():
+            if STORAGE_MODE == "journal":
+                key, known = _stat_key(cls._journal_path(shard)), "journal"
+            else:
+                key, known = _stat_key(cls._snapshot_path(shard)), "snapshot"
+            if key != sync[known]:
+                changed.append(shard)
+        if not changed:
+            return
+        flush()
+        with STORAGE_LOCK, cls._lock().write():
+            for shard in changed:
+                with cls._journal_lock(shard, False):
+                    if STORAGE_MODE != "journal" or not cls._tail(shard):
+                        cls._merge(cls._read_files(shard)[0], shard)
+
+    @classmethod
+    def _tail(cls, shard: int) -> bool:
+        """ Apply the records appended to the journal of a shard since
+        the last one read, following it into its rotated file. False
+        when that journal was compacted away.
+        """
+        sync = _SYNC[cls][shard]
+        journal_path = cls._journal_path(shard)
+        key = _stat_key(journal_path)
+        current = journal.generation(journal_path)
+        if sync["generation"] == current:
+            files = [(journal_path, sync["offset"])]
+        elif (sync["generation"] is not None and sync["generation"] ==
+                journal.generation(journal_path + ".old")):
+            files = [(journal_path + ".old", sync["offset"]),
+                     (journal_path, 0)]
+        else:
+            return False
+        for file_name, offset in files:
+            records, sync["offset"] = journal.read(file_name, offset)
+            for record in records:
+                cls._apply(record)
+        sync["journal"] = key
+        sync["generation"] = current
+        return True
+
+    @classmethod
+    @contextmanager
+    def _journal_lock(cls, shard: int, exclusive: bool) -> Iterator[None]:
+        """ Hold the lock file of the journal of a shard, shared by the
+        processes appending to or reading it, or exclusive to load or
+        rotate it. Does nothing in snapshot mode.
+        """
+        if STORAGE_MODE != "journal":
+            yield
+            return
+        lock_path = cls._lock_path(shard)
+        entry = _LOCK_FILES.get(lock_path)
+        if entry is None or entry[0] != os.getpid():
+            entry = (os.getpid(), open(lock_path, 'a'))
+            _LOCK_FILES[lock_path] = entry
+        fcntl.flock(entry[1], fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(entry[1], fcntl.LOCK_UN)
+
+    @classmethod
+    def _snapshot(cls, shard: int) -> list:
+        """ JSON members, or binary rows, of the file of a shard,
+        reusing the memoized ones of the objects that did not change
+        """
+        with cls._lock().read():
+            objs = cls._shard_objects(shard)
+            if SNAPSHOT_FORMAT == "binary":
+                return [obj._row() for obj in objs.values()]
+            return [
+                "{}: {}".format(json.dumps(obj_id), obj._encoded())
+                for obj_id, obj in objs.items()
+            ]
+
+    @classmethod
+    def _dump_snapshot(cls, members: list, f):
+        """ Write JSON members as one object, or binary rows
+        """
+        if SNAPSHOT_FORMAT == "binary":
+            snapshot.dump(f, cls._fields(), members, SNAPSHOT_COMPRESSION)
+            return
+        f.write("{")
+        f.write(", ".join(members))
+        f.write("}")
+
+    @classmethod
+    def _write_snapshot(cls, shard: int, members: list):
+        """ Replace the file of a shard through a temporary file, so
+        that readers and crashes never see it partly written
+        """
+        file_path = cls._snapshot_path(shard)
+        tmp_path = "{}.{}.{}.tmp".format(file_path, os.getpid(), get_ident())
+        mode = 'wb' if SNAPSHOT_FORMAT == "binary" else 'w'
+        try:
+            with open(tmp_path, mode) as f:
+                cls._dump_snapshot(members, f)
+                f.flush()
+                os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+            os.replace(tmp_path, file_path)
+        finally:
+            if path.exists(tmp_path):
+                os.remove(tmp_path)
+        sync = _SYNC.get(cls, {}).get(shard)
+        if sync is not None:
+            sync["snapshot"] = st.st_ino, st.st_size, st.st_mtime_ns
+
+    @classmethod
+    def _remove_journals(cls, shard: int):
+        """ Delete the journal files of a shard
+        """
+        journal_path = cls._journal_path(shard)
+        for file_name in (journal_path + ".old", journal_path):
+            if path.exists(file_name):
+                os.remove(file_name)
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        with STORAGE_LOCK:
+            for shard in range(SHARDS):
+                cls._write_snapshot(shard, cls._snapshot(shard))
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def _persist(cls, record: dict):
+        """ Persist one mutation, or queue it for the next flush. The
+        mutations another thread queued for the class are written first,
+        so the files see them in the order they were made.
+        """
+        if getattr(_UNIT_OF_WORK, 'depth', 0) > 0 or _FLUSHER is not None:
+            _PENDING.setdefault(cls, []).append(record)
+            return
+        records = _PENDING.pop(cls, [])
+        records.append(record)
+        cls._write(records)
+
+    @classmethod
+    def _write(cls, records: List[dict]):
+        """ Write mutations to the files of their shards only, according
+        to the storage mode
+        """
+        shards = {}
+        for record in records:
+            shards.setdefault(_shard_of(record["id"]), []).append(record)
+        for shard, shard_records in shards.items():
+            if STORAGE_MODE != "journal":
+                cls._write_snapshot(shard, cls._snapshot(shard))
+            else:
+                cls._append(shard, shard_records)
+
+    @classmethod
+    def _append(cls, shard: int, records: List[dict]):
+        """ Append mutations to the journal of a shard. Records that
+        directly follow the last one read need not be read back.
+        """
+        journal_path = cls._journal_path(shard)
+        with cls._journal_lock(shard, False):
+            current = journal.generation(journal_path)
+            start, end = journal.append(journal_path, records)
+        sync = _SYNC.get(cls, {}).get(shard)
+        if sync is not None and start == sync["offset"]:
+            if start == 0 or current == sync["generation"]:
+                sync["generation"] = journal.generation(journal_path)
+                sync["offset"] = end
+        if end >= JOURNAL_COMPACT_SIZE:
+            cls._start_compaction(shard)
+
+    @classmethod
+    def _start_compaction(cls, shard: int):
+        """ Rotate the journal of a shard and write its snapshot in the
+        background. Until the snapshot is in place, the rotated journal
+        is replayed on load along with the new one. The writer holds the
+        lock file through its own descriptor, shared while it writes and
+        exclusive to delete the rotated journal, so that no load or
+        refresh reads an old snapshot without it.
+        """
+        journal_path = cls._journal_path(shard)
+        lock_path = cls._lock_path(shard)
+        with cls._lock().write(), cls._journal_lock(shard, True):
+            if (path.exists(journal_path + ".old") or
+                    _stat_key(journal_path) is None or
+                    path.getsize(journal_path) < JOURNAL_COMPACT_SIZE):
+                return
+            sync = _SYNC.get(cls, {}).get(shard)
+            if sync is not None and not cls._tail(shard):
+                cls._merge(cls._read_files(shard)[0], shard)
+            os.replace(journal_path, journal_path + ".old")
+            end = journal.append(journal_path, [])[1]
+            if sync is not None:
+                sync["generation"] = journal.generation(journal_path)
+                sync["offset"] = end
+            members = cls._snapshot(shard)
+
+        def compact():
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                cls._write_snapshot(shard, members)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    os.remove(journal_path + ".old")
+                except FileNotFoundError:
+                    pass
+
+        threading.Thread(target=compact, daemon=True).start()
 
     def save(self):
         """ Save current object
         """
         s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        if ENGINE is not None:
+            self.updated_at = datetime.utcnow()
+            ENGINE.save(self)
+            return
+        with STORAGE_LOCK:
+            with self._lock().write():
+                self.updated_at = datetime.utcnow()
+                stored = DATA[s_class].get(self.id)
+                if stored is not None:
+                    stored._unindex(replaced=True)
+                DATA[s_class][self.id] = self
+                self._index()
+            record = {"op": "save", "id": self.id, "obj": self.to_json(True)}
+            self.__class__._persist(record)
 
     def remove(self):
         """ Remove object
         """
         s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        if ENGINE is not None:
+            ENGINE.remove(self)
+            return
+        with STORAGE_LOCK:
+            with self._lock().write():
+                stored = DATA[s_class].pop(self.id, None)
+                if stored is not None:
+                    stored._unindex()
+            if stored is not None:
+                self.__class__._persist({"op": "remove", "id": self.id})
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
+        if ENGINE is not None:
+            return ENGINE.count(cls)
         s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        with cls._lock().read():
+            return len(DATA[s_class].keys())
+
+    @classmethod
+    def stats(cls, since: datetime = None) -> dict:
+        """ Number of objects, and by day of creation, read from counters
+        kept as objects are stored and removed. With since, also the
+        number of objects created at or after it.
+        """
+        if ENGINE is not None:
+            if since is not None:
+                since = snapshot.timestamp_to_int(since)
+            return ENGINE.stats(cls, since)
+        with cls._lock().read():
+            stats = STATS.get(cls.__name__)
+            if stats is None:
+                stats = Stats()
+            return cls._summarize(stats, since)
+
+    @staticmethod
+    def _summarize(stats: Stats, since: datetime = None) -> dict:
+        """ Counts of some stats
+        """
+        summary = {"count": stats.count(), "per_day": stats.per_day()}
+        if since is not None:
+            seconds = snapshot.timestamp_to_int(since)
+            summary["since"] = stats.created_since(seconds)
+        return summary
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +948,158 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
+        if ENGINE is not None:
+            return ENGINE.get(cls, id)
         s_class = cls.__name__
-        return DATA[s_class].get(id)
+        with cls._lock().read():
+            return DATA[s_class].get(id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
+        if ENGINE is not None:
+            return ENGINE.search(cls, attributes)
+        return cls.query(attributes).all()
+
+    @classmethod
+    def query(cls, attributes: dict = {}) -> Query:
+        """ Lazy query on the objects, with matching attributes
+        """
+        return Query(cls).filter(**attributes)
+
+    @classmethod
+    def _execute(cls, query: Query) -> Iterator[TypeVar('Base')]:
+        """ Objects matching a query, starting from an index when one of
+        its equalities is on an indexed attribute. A bounded query is
+        run under the read lock, and stops at its last result or, when
+        ordered, keeps no more results than it returns; unordered or
+        ordered by id without an index, it walks the ids in order from
+        its lower bound. Otherwise the index candidates are copied, or
+        all objects scanned by chunks in id order, and filtered as they
+        are iterated, or sorted when the query is ordered.
+        """
+        if ENGINE is not None:
+            candidates = ENGINE.search(cls, query.equalities())
+            return islice(query.sort(filter(query.matches, candidates)),
+                          query.start, query.stop)
         s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        with cls._lock().read():
+            objs = DATA[s_class]
+            candidates = None
+            for k, v in query.equalities().items():
+                if k not in cls.indexed_attributes:
+                    continue
+                try:
+                    candidates = INDEXES[s_class][k][0].get(v, {}).values()
+                except TypeError:
+                    continue
+                break
+            if query.stop is not None:
+                if candidates is None and query.ordering in (None, 'id'):
+                    after, inclusive = query.lower_bound('id')
+                    if type(after) is not str:
+                        after, inclusive = None, False
+                    ids = IDS[s_class].after(after, inclusive)
+                    results = filter(query.matches, map(objs.get, ids))
+                else:
+                    if candidates is None:
+                        candidates = objs.values()
+                    results = query.sort(filter(query.matches, candidates))
+                return iter(list(islice(results, query.start, query.stop)))
+            if candidates is not None:
+                candidates = tuple(candidates)
+        if candidates is None:
+            results = cls._scan(query)
+        else:
+            results = filter(query.matches, candidates)
+        return islice(query.sort(results), query.start, None)
+
+    @classmethod
+    def _scan(cls, query: Query) -> Iterator[TypeVar('Base')]:
+        """ Objects matching a query in id order from its lower bound,
+        read SCAN_CHUNK_SIZE ids at a time under the read lock, which
+        is released between chunks
+        """
+        s_class = cls.__name__
+        after, inclusive = query.lower_bound('id')
+        if type(after) is not str:
+            after, inclusive = None, False
+        while True:
+            with cls._lock().read():
+                ids = IDS[s_class].after(after, inclusive)
+                ids = list(islice(ids, SCAN_CHUNK_SIZE))
+                chunk = list(filter(query.matches,
+                                    map(DATA[s_class].get, ids)))
+            yield from chunk
+            if len(ids) < SCAN_CHUNK_SIZE:
+                return
+            after, inclusive = ids[-1], False
+
+
+def flush():
+    """ Write all pending mutations, once per class
+    """
+    with STORAGE_LOCK:
+        while _PENDING:
+            cls, records = _PENDING.popitem()
+            cls._write(records)
+
+
+def refresh():
+    """ Apply the changes other processes made to the loaded classes
+    """
+    for cls in list(_SYNC):
+        cls.refresh()
+
+
+@contextmanager
+def unit_of_work() -> Iterator[None]:
+    """ Defer the writes of the enclosed saves and removes to a
+    single flush per class when the outermost block exits
+    """
+    _UNIT_OF_WORK.depth = getattr(_UNIT_OF_WORK, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _UNIT_OF_WORK.depth -= 1
+        if _UNIT_OF_WORK.depth == 0:
+            flush()
+
+
+def start_flusher(interval_ms: int):
+    """ Defer all writes to a thread flushing every interval_ms
+    """
+    global _FLUSHER
+    if _FLUSHER is not None:
+        return
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval_ms / 1000):
+            flush()
+
+    thread = threading.Thread(target=run, daemon=True)
+    _FLUSHER = (thread, stop)
+    thread.start()
+
+
+@atexit.register
+def stop_flusher():
+    """ Stop the background flusher and drain the pending writes
+    """
+    global _FLUSHER
+    if _FLUSHER is not None:
+        thread, stop = _FLUSHER
+        stop.set()
+        thread.join()
+        _FLUSHER = None
+    flush()
+
+
+if getenv("MODELS_FLUSH_INTERVAL_MS"):
+    start_flusher(int(getenv("MODELS_FLUSH_INTERVAL_MS")))
+
+
+Base.created_at = LazyTimestamp(Base.created_at)
+Base.updated_at = LazyTimestamp(Base.updated_at)
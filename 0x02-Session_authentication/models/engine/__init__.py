@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+""" Storage engines module
+
+The JSON files handled by models.base are the default storage. An
+engine selected with MODELS_STORAGE_ENGINE takes over the storage of
+every model class through the StorageEngine interface.
+"""
+from typing import TypeVar, List
+
+
+class StorageEngine():
+    """ Interface of a storage engine
+    """
+
+    def load(self, cls: type):
+        """ Prepare the storage of a model class
+        """
+        raise NotImplementedError()
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace one object
+        """
+        raise NotImplementedError()
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+        raise NotImplementedError()
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of a model class
+        """
+        raise NotImplementedError()
+
+    def stats(self, cls: type, since: int = None) -> dict:
+        """ Number of objects as "count", by ISO day of creation as
+        "per_day" and, with since in seconds since the epoch, created at
+        or after it as "since"
+        """
+        raise NotImplementedError()
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        raise NotImplementedError()
+
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects with matching attributes
+        """
+        raise NotImplementedError()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+""" SQLite storage engine module
+
+Each model class is stored in a table named after it, with the id as
+primary key, one indexed column per entry of indexed_attributes, the
+creation time in seconds since the epoch in an indexed created column
+and the serialized object in a data column. Triggers keep the number
+of objects created each day in a <table>_days table, which stats()
+reads without scanning the objects.
+
+    python3 -m models.engine.sqlite_storage
+
+imports the existing .db_User.json and .db_UserSession.json files.
+"""
+from datetime import date, timedelta
+from typing import TypeVar, List
+from os import getenv
+import json
+import sqlite3
+import threading
+
+from models.engine import StorageEngine
+
+
+DAY = 86400
+EPOCH = date(1970, 1, 1)
+DAYS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_days_insert" AFTER INSERT ON "{0}"
+    BEGIN
+        INSERT INTO "{0}_days" (day, count)
+        SELECT NEW.created / {1}, 1 WHERE NEW.created IS NOT NULL
+        ON CONFLICT (day) DO UPDATE SET count = count + 1;
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_days_delete" AFTER DELETE ON "{0}"
+    BEGIN
+        UPDATE "{0}_days" SET count = count - 1
+        WHERE day = OLD.created / {1};
+        DELETE FROM "{0}_days" WHERE day = OLD.created / {1} AND count = 0;
+    END;''',
+    '''CREATE TRIGGER IF NOT EXISTS "{0}_days_update"
+    AFTER UPDATE OF created ON "{0}" WHEN OLD.created IS NOT NEW.created
+    BEGIN
+        UPDATE "{0}_days" SET count = count - 1
+        WHERE day = OLD.created / {1};
+        DELETE FROM "{0}_days" WHERE day = OLD.created / {1} AND count = 0;
+        INSERT INTO "{0}_days" (day, count)
+        SELECT NEW.created / {1}, 1 WHERE NEW.created IS NOT NULL
+        ON CONFLICT (day) DO UPDATE SET count = count + 1;
+    END;''',
+)
+
+
+class SQLiteStorage(StorageEngine):
+    """ SQLite storage engine
+    """
+
+    def __init__(self, db_path: str):
+        """ Initialize the engine on a database file
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._tables = set()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path)
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("PRAGMA synchronous=NORMAL;")
+            self._local.connection = connection
+        return connection
+
+    def load(self, cls: type):
+        """ Create the table, indexes and day counters of a model class.
+        A table from before the created column gets it filled from the
+        serialized objects, and the counters are filled when created.
+        """
+        table = cls.__name__
+        columns = "".join(
+            ', "{}"'.format(attr) for attr in cls.indexed_attributes
+        )
+        with self.connection as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" (id TEXT PRIMARY KEY{}, '
+                'created INTEGER, data TEXT NOT NULL);'.format(
+                    table, columns
+                )
+            )
+            names = [row[1] for row in connection.execute(
+                'PRAGMA table_info("{}");'.format(table)
+            )]
+            if "created" not in names:
+                connection.execute(
+                    'ALTER TABLE "{}" ADD COLUMN created INTEGER;'.format(
+                        table
+                    )
+                )
+                connection.execute(
+                    'UPDATE "{}" SET created = CAST(strftime(\'%s\', '
+                    'json_extract(data, \'$.created_at\')) AS INTEGER);'
+                    .format(table)
+                )
+            for attr in cls.indexed_attributes + ("created",):
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "{0}_{1}" '
+                    'ON "{0}" ("{1}");'.format(table, attr)
+                )
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?;", (table + "_days",)
+            ).fetchone()
+            if exists is None:
+                connection.execute(
+                    'CREATE TABLE "{}_days" (day INTEGER PRIMARY KEY, '
+                    'count INTEGER NOT NULL);'.format(table)
+                )
+                connection.execute(
+                    'INSERT INTO "{0}_days" (day, count) '
+                    'SELECT created / {1}, COUNT(*) FROM "{0}" '
+                    'WHERE created IS NOT NULL GROUP BY 1;'.format(
+                        table, DAY
+                    )
+                )
+            for trigger in DAYS_TRIGGERS:
+                connection.execute(trigger.format(table, DAY))
+        self._tables.add(table)
+
+    def _table(self, cls: type) -> str:
+        """ Table name of a model class, created on first use
+        """
+        if cls.__name__ not in self._tables:
+            self.load(cls)
+        return cls.__name__
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace one object
+        """
+        cls = obj.__class__
+        table = self._table(cls)
+        attrs = cls.indexed_attributes
+        columns = ['"{}"'.format(attr) for attr in attrs]
+        columns += ["created", "data"]
+        values = [obj.id]
+        values += [getattr(obj, attr, None) for attr in attrs]
+        values += [obj._created_seconds(), obj._encoded()]
+        with self.connection as connection:
+            connection.execute(
+                'INSERT INTO "{}" (id, {}) VALUES ({}) '
+                'ON CONFLICT (id) DO UPDATE SET {};'.format(
+                    table,
+                    ", ".join(columns),
+                    ", ".join("?" * len(values)),
+                    ", ".join(
+                        "{0} = excluded.{0}".format(column)
+                        for column in columns
+                    ),
+                ),
+                values,
+            )
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+        table = self._table(obj.__class__)
+        with self.connection as connection:
+            connection.execute(
+                'DELETE FROM "{}" WHERE id = ?;'.format(table), (obj.id,)
+            )
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of a model class
+        """
+        table = self._table(cls)
+        cursor = self.connection.execute(
+            'SELECT COUNT(*) FROM "{}";'.format(table)
+        )
+        return cursor.fetchone()[0]
+
+    def stats(self, cls: type, since: int = None) -> dict:
+        """ Number of objects, and by day of creation, read from the day
+        counters. With since, also the number of objects created at or
+        after it, in seconds since the epoch, counted on the index.
+        """
+        table = self._table(cls)
+        days = self.connection.execute(
+            'SELECT day, count FROM "{}_days" ORDER BY day;'.format(table)
+        ).fetchall()
+        summary = {
+            "count": sum(count for _, count in days),
+            "per_day": {
+                (EPOCH + timedelta(days=day)).isoformat(): count
+                for day, count in days
+            },
+        }
+        if since is not None:
+            summary["since"] = self.connection.execute(
+                'SELECT COUNT(*) FROM "{}" WHERE created >= ?;'.format(table),
+                (since,)
+            ).fetchone()[0]
+        return summary
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        table = self._table(cls)
+        row = self.connection.execute(
+            'SELECT data FROM "{}" WHERE id = ?;'.format(table), (id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return cls._hydrate(json.loads(row[0]))
+
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects with matching attributes. The id and
+        indexed attributes are matched in SQL, the others on the
+        loaded objects.
+        """
+        table = self._table(cls)
+        clauses, values, others = [], [], {}
+        for k, v in attributes.items():
+            if k == 'id' or k in cls.indexed_attributes:
+                clauses.append('"{}" IS ?'.format(k))
+                values.append(v)
+            else:
+                others[k] = v
+        query = 'SELECT data FROM "{}"'.format(table)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        result = []
+        for row in self.connection.execute(query + ";", values):
+            obj = cls._hydrate(json.loads(row[0]))
+            if all(getattr(obj, k, None) == v
+                   for k, v in others.items()):
+                result.append(obj)
+        return result
+
+
+def migrate(engine: SQLiteStorage, classes: List[type]) -> dict:
+    """ Import the JSON files of the given classes into the engine
+    """
+    from models.base import DATA
+
+    counts = {}
+    for cls in classes:
+        cls._load_json()
+        engine.load(cls)
+        for obj in DATA[cls.__name__].values():
+            engine.save(obj)
+        counts[cls.__name__] = len(DATA[cls.__name__])
+    return counts
+
+
+if __name__ == "__main__":
+    from models.user import User
+    from models.user_session import UserSession
+
+    db_path = getenv("MODELS_SQLITE_PATH", ".db.sqlite3")
+    for name, count in migrate(
+        SQLiteStorage(db_path), [User, UserSession]
+    ).items():
+        print("{}: {} objects imported into {}".format(name, count, db_path))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+""" Journal module
+
+Append-only log of model mutations. Each record is one line:
+the CRC32 of the JSON payload in hex, a tab, then the payload.
+
+The first record of a journal names its generation, so that a
+process following it by offset notices when it was rotated.
+"""
+from typing import List, Optional, Tuple
+from os import path
+import json
+import os
+import uuid
+import zlib
+
+
+def encode_record(record: dict) -> bytes:
+    """ Encode one journal record as a checksummed line
+    """
+    payload = json.dumps(record).encode('utf-8')
+    return b"%08x\t%s\n" % (zlib.crc32(payload), payload)
+
+
+def decode_record(line: bytes) -> Optional[dict]:
+    """ Decode one checksummed line, or None if it is torn or corrupted
+    """
+    if not line.endswith(b"\n"):
+        return None
+    crc, _, payload = line[:-1].partition(b"\t")
+    try:
+        if int(crc, 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def append(file_path: str, records: List[dict]) -> Tuple[int, int]:
+    """ Append records to a journal and force them to disk, starting
+    a new journal with its generation record. Return the offsets the
+    written records start and end at.
+    """
+    data = b"".join(map(encode_record, records))
+    with open(file_path, 'ab') as f:
+        if f.tell() == 0:
+            header = {"op": "generation", "generation": uuid.uuid4().hex}
+            data = encode_record(header) + data
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        end = f.tell()
+    return end - len(data), end
+
+
+def generation(file_path: str) -> Optional[str]:
+    """ Generation of a journal, None if it does not exist
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            record = decode_record(f.readline())
+    except FileNotFoundError:
+        return None
+    if record is None or record.get("op") != "generation":
+        return None
+    return record["generation"]
+
+
+def read(file_path: str, offset: int = 0,
+         repair: bool = False) -> Tuple[List[dict], int]:
+    """ Records of a journal from offset on, and the offset following
+    the last one. A torn or corrupted last record ends the read: it may
+    be an append in progress, or with repair the remains of a crash,
+    cut off the file so that later appends start on a clean line. A
+    corrupted record followed by others raises ValueError and leaves
+    the file as it is.
+    """
+    records = []
+    if not path.exists(file_path):
+        return records, offset
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            record = decode_record(line)
+            if record is None:
+                if f.read(1):
+                    raise ValueError("corrupted record in {} at offset {}"
+                                     .format(file_path, offset))
+                break
+            offset += len(line)
+            records.append(record)
+    if repair and offset < path.getsize(file_path):
+        with open(file_path, 'r+b') as f:
+            f.truncate(offset)
+    return records, offset
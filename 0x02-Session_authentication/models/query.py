@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+""" Query module
+
+    User.query({"email": email}).first()
+    User.query().where("created_at", ">=", since).offset(20).limit(10)
+    User.query().where("id", ">", cursor).order_by("id").limit(100)
+
+A query holds predicates on the attributes of a model class and is
+only run when iterated, or by first(), exists(), count() and all().
+"""
+from typing import Any, Iterable, Iterator, List, TypeVar
+import heapq
+import operator
+
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, values: value in values,
+}
+
+
+class Query():
+    """ Lazy query on the objects of a model class. Each method adding
+    a predicate or a bound returns a new query. As in SQL, the offset
+    and the limit are set independently of each other: the results
+    are the limit first ones after the offset first ones, whatever
+    order offset() and limit() are called in.
+    """
+
+    def __init__(self, cls: type, predicates: tuple = (),
+                 start: int = 0, size: int = None, ordering: str = None):
+        """ Initialize a query on the objects of cls
+        """
+        self.cls = cls
+        self.predicates = predicates
+        self.start = start
+        self.size = size
+        self.ordering = ordering
+
+    @property
+    def stop(self) -> int:
+        """ Index after the last result, None without a limit
+        """
+        if self.size is None:
+            return None
+        return self.start + self.size
+
+    def _copy(self, **kwargs: dict) -> 'Query':
+        """ Copy of the query with some fields replaced
+        """
+        fields = {
+            "predicates": self.predicates,
+            "start": self.start,
+            "size": self.size,
+            "ordering": self.ordering,
+        }
+        fields.update(kwargs)
+        return Query(self.cls, **fields)
+
+    def where(self, name: str, op: str, value: Any) -> 'Query':
+        """ Keep the objects whose attribute compares to value with one
+        of the OPERATORS
+        """
+        if op not in OPERATORS:
+            raise ValueError("unknown operator {}".format(op))
+        return self._copy(predicates=self.predicates + ((name, op, value),))
+
+    def filter(self, **attributes: dict) -> 'Query':
+        """ Keep the objects whose attributes equal the given values
+        """
+        query = self
+        for name, value in attributes.items():
+            query = query.where(name, "==", value)
+        return query
+
+    def offset(self, count: int) -> 'Query':
+        """ Skip the first count results, in place of any previous offset
+        """
+        return self._copy(start=count)
+
+    def limit(self, count: int) -> 'Query':
+        """ Return at most count results, in place of any previous limit
+        """
+        return self._copy(size=count)
+
+    def order_by(self, name: str) -> 'Query':
+        """ Return the results by ascending attribute, None last
+        """
+        return self._copy(ordering=name)
+
+    def equalities(self) -> dict:
+        """ Attributes the objects must equal
+        """
+        return {name: value for name, op, value in self.predicates
+                if op == "=="}
+
+    def lower_bound(self, name: str) -> tuple:
+        """ (value, inclusive) of the highest > or >= predicate on an
+        attribute, (None, False) without any or when their values do
+        not compare
+        """
+        bound = (None, False)
+        for attr, op, value in self.predicates:
+            if attr != name or op not in (">", ">="):
+                continue
+            try:
+                if bound[0] is None or value > bound[0] or \
+                        (value == bound[0] and op == ">"):
+                    bound = (value, op == ">=")
+            except TypeError:
+                return (None, False)
+        return bound
+
+    def matches(self, obj: TypeVar('Base')) -> bool:
+        """ Check an object against all the predicates. Values that
+        cannot be compared do not match.
+        """
+        for name, op, value in self.predicates:
+            try:
+                if not OPERATORS[op](getattr(obj, name, None), value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def sort(self, objs: Iterable[TypeVar('Base')]) -> Iterable:
+        """ Put matching objects in the order of the query. A bounded
+        query only keeps its first stop objects while they are scanned.
+        """
+        if self.ordering is None:
+            return objs
+
+        def key(obj):
+            value = getattr(obj, self.ordering, None)
+            return value is None, value
+
+        if self.stop is not None:
+            return heapq.nsmallest(self.stop, objs, key=key)
+        return sorted(objs, key=key)
+
+    def __iter__(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the results
+        """
+        return self.cls._execute(self)
+
+    def first(self) -> TypeVar('Base'):
+        """ First result, None if there is none
+        """
+        size = 1 if self.size is None else min(self.size, 1)
+        return next(iter(self.limit(size)), None)
+
+    def exists(self) -> bool:
+        """ Check if there is any result
+        """
+        return self.first() is not None
+
+    def count(self) -> int:
+        """ Number of results
+        """
+        return sum(1 for _ in self)
+
+    def all(self) -> List[TypeVar('Base')]:
+        """ List of all results
+        """
+        return list(self)
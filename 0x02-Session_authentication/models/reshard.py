@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" Resharding module
+
+    MODELS_SHARDS=4 python3 -m models.reshard 16
+
+moves the objects of User and UserSession from the MODELS_SHARDS
+shards they are stored in to 16 shards, in the same storage mode and
+snapshot format. No other process may use the files meanwhile, and
+MODELS_SHARDS must then be set to the new count.
+"""
+from typing import List
+import argparse
+import os
+
+from models import base
+
+
+def reshard(classes: List[type], shards: int) -> dict:
+    """ Move the objects of the given classes from the current number
+    of shards to shards, then delete the files of the previous ones
+    """
+    previous = base.SHARDS
+    counts = {}
+    for cls in classes:
+        base.SHARDS = previous
+        cls.load_from_file()
+        old_files = []
+        for shard in range(previous):
+            journal_path = cls._journal_path(shard)
+            old_files += [cls._snapshot_path(shard), journal_path,
+                          journal_path + ".old",
+                          cls._lock_path(shard)]
+        with base.STORAGE_LOCK, cls._lock().write():
+            base.SHARDS = shards
+            cls._reset_indexes()
+            for obj in base.DATA[cls.__name__].values():
+                obj._index()
+            cls._bulk_index()
+            base._SYNC.pop(cls, None)
+            cls.save_to_file()
+            new_files = {cls._snapshot_path(shard) for shard in range(shards)}
+            for file_name in old_files:
+                entry = base._LOCK_FILES.pop(file_name, None)
+                if entry is not None:
+                    entry[1].close()
+                if file_name not in new_files and os.path.exists(file_name):
+                    os.remove(file_name)
+        counts[cls.__name__] = len(base.DATA[cls.__name__])
+    return counts
+
+
+if __name__ == "__main__":
+    from models.user import User
+    from models.user_session import UserSession
+
+    parser = argparse.ArgumentParser(
+        description="Move the models to another number of shards"
+    )
+    parser.add_argument("shards", type=int)
+    args = parser.parse_args()
+    for name, count in reshard([User, UserSession], args.shards).items():
+        print("{}: {} objects moved to {} shards".format(
+            name, count, args.shards
+        ))
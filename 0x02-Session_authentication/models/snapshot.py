@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+""" Binary snapshot module
+
+A binary snapshot holds the objects of one class as rows of values,
+in the order of a list of fields, with timestamps as integer seconds
+since the epoch. The file starts with a header:
+
+    magic (4 bytes) | version | compression | CRC32 of the body
+
+and the body is the pickle (protocol 4) encoding of (fields, rows),
+compressed with zlib or lzma, or not at all. Every later Python reads
+that protocol, and rows only hold strings, numbers, None, lists and
+dicts: loading refuses any other object.
+
+    python3 -m models.snapshot .db_User.json .db_User.bin --compression zlib
+    python3 -m models.snapshot .db_User.bin .db_User.json
+
+converts a snapshot between the JSON and binary formats.
+"""
+from datetime import datetime, timedelta
+from typing import BinaryIO, List, Tuple
+import argparse
+import io
+import json
+import lzma
+import pickle
+import struct
+import zlib
+
+
+MAGIC = b"MDBS"
+VERSION = 3
+PROTOCOL = 4
+HEADER = struct.Struct("<4sBBI")
+COMPRESSIONS = {
+    "none": (0, lambda data: data, lambda data: data),
+    "zlib": (1, lambda data: zlib.compress(data, 1), zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+TIMESTAMP_ATTRIBUTES = ("created_at", "updated_at")
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+EXTRAS = "__dict__"
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+
+
+def timestamp_to_int(value) -> int:
+    """ Seconds since the epoch of a datetime or serialized timestamp
+    """
+    if type(value) is int:
+        return value
+    if type(value) is str:
+        value = datetime.fromisoformat(value)
+    return (value - EPOCH) // SECOND
+
+
+def int_to_datetime(value: int) -> datetime:
+    """ Datetime of a number of seconds since the epoch
+    """
+    return EPOCH + timedelta(seconds=value)
+
+
+class _RowUnpickler(pickle.Unpickler):
+    """ Unpickler of plain values, refusing to import any class
+    """
+
+    def find_class(self, module: str, name: str):
+        """ Refuse the global a snapshot should not reference
+        """
+        raise ValueError("binary snapshot references {}.{}".format(
+            module, name))
+
+
+def encode(fields: List[str], rows: List[tuple]) -> bytes:
+    """ Pickle encoding of fields and rows, without the memo that
+    plain rows do not need
+    """
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, PROTOCOL)
+    pickler.fast = True
+    pickler.dump((list(fields), rows))
+    return buffer.getvalue()
+
+
+def decode(data: bytes) -> Tuple[List[str], List[tuple]]:
+    """ Fields and rows of their pickle encoding
+    """
+    try:
+        return _RowUnpickler(io.BytesIO(data)).load()
+    except pickle.UnpicklingError as e:
+        raise ValueError("corrupted binary snapshot: {}".format(e))
+
+
+def dump(f: BinaryIO, fields: List[str], rows: List[tuple],
+         compression: str = "none"):
+    """ Write rows of values of the fields as a binary snapshot
+    """
+    code, compress, _ = COMPRESSIONS[compression]
+    body = compress(encode(fields, rows))
+    f.write(HEADER.pack(MAGIC, VERSION, code, zlib.crc32(body)))
+    f.write(body)
+
+
+def load(f: BinaryIO) -> Tuple[List[str], List[tuple]]:
+    """ Read the fields and rows of a binary snapshot
+    """
+    magic, version, code, crc = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a binary snapshot")
+    body = f.read()
+    if zlib.crc32(body) != crc:
+        raise ValueError("corrupted binary snapshot")
+    for number, _, decompress in COMPRESSIONS.values():
+        if number == code:
+            return decode(decompress(body))
+    raise ValueError("unknown compression {}".format(code))
+
+
+def row_to_dict(fields: List[str], row: tuple) -> dict:
+    """ Serialized object of a row, timestamps left as integers
+    """
+    obj_json = dict(zip(fields, row))
+    extras = obj_json.pop(EXTRAS, None)
+    if extras:
+        obj_json.update(extras)
+    return obj_json
+
+
+def from_json(objs_json: dict) -> Tuple[List[str], List[tuple]]:
+    """ Fields and rows of the objects of a JSON snapshot
+    """
+    fields = {}
+    for obj_json in objs_json.values():
+        fields.update(dict.fromkeys(obj_json))
+    fields = list(fields)
+    rows = []
+    for obj_json in objs_json.values():
+        row = []
+        for name in fields:
+            value = obj_json.get(name)
+            if name in TIMESTAMP_ATTRIBUTES and value is not None:
+                value = timestamp_to_int(value)
+            row.append(value)
+        rows.append(tuple(row))
+    return fields, rows
+
+
+def to_json(fields: List[str], rows: List[tuple]) -> dict:
+    """ Objects of a binary snapshot as in a JSON snapshot
+    """
+    objs_json = {}
+    for row in rows:
+        obj_json = row_to_dict(fields, row)
+        for name in TIMESTAMP_ATTRIBUTES:
+            if type(obj_json.get(name)) is int:
+                value = int_to_datetime(obj_json[name])
+                obj_json[name] = value.strftime(TIMESTAMP_FORMAT)
+        objs_json[obj_json["id"]] = obj_json
+    return objs_json
+
+
+def convert(src: str, dest: str, compression: str = "none"):
+    """ Convert a JSON snapshot to binary, or a binary one to JSON,
+    depending on the extension of src
+    """
+    if src.endswith(".json"):
+        with open(src, 'r') as f:
+            fields, rows = from_json(json.load(f))
+        with open(dest, 'wb') as f:
+            dump(f, fields, rows, compression)
+    else:
+        with open(src, 'rb') as f:
+            objs_json = to_json(*load(f))
+        with open(dest, 'w') as f:
+            json.dump(objs_json, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a snapshot between the JSON and binary formats"
+    )
+    parser.add_argument("src", help="a .json or binary snapshot")
+    parser.add_argument("dest")
+    parser.add_argument("--compression", choices=COMPRESSIONS,
+                        default="none")
+    args = parser.parse_args()
+    convert(args.src, args.dest, args.compression)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+""" Sorted keys module
+
+Keys are kept sorted in a list of blocks of up to 2 * LOAD keys, with
+the last key of each block in maxes: adding or discarding a key only
+shifts the keys of its block, and the keys after any one are walked
+from the block found by bisecting maxes.
+"""
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable, Iterator
+
+
+LOAD = 1000
+
+
+class SortedKeys():
+    """ Set of keys walked in ascending order
+    """
+
+    def __init__(self, keys: Iterable[Any] = ()):
+        """ Sort the initial keys into blocks
+        """
+        keys = sorted(set(keys))
+        self.blocks = [keys[i:i + LOAD] for i in range(0, len(keys), LOAD)]
+        self.maxes = [block[-1] for block in self.blocks]
+
+    def __len__(self) -> int:
+        """ Number of keys
+        """
+        return sum(len(block) for block in self.blocks)
+
+    def add(self, key: Any):
+        """ Add a key, if it is not there yet
+        """
+        if not self.blocks:
+            self.blocks.append([key])
+            self.maxes.append(key)
+            return
+        i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+        block = self.blocks[i]
+        j = bisect_left(block, key)
+        if j < len(block) and block[j] == key:
+            return
+        block.insert(j, key)
+        self.maxes[i] = block[-1]
+        if len(block) > 2 * LOAD:
+            self.blocks[i:i + 1] = [block[:LOAD], block[LOAD:]]
+            self.maxes[i:i + 1] = [block[LOAD - 1], block[-1]]
+
+    def discard(self, key: Any):
+        """ Remove a key, if it is there
+        """
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return
+        block = self.blocks[i]
+        j = bisect_left(block, key)
+        if block[j] != key:
+            return
+        del block[j]
+        if not block:
+            del self.blocks[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = block[-1]
+
+    def after(self, key: Any = None, inclusive: bool = False) -> Iterator:
+        """ Iterate over the keys above key, or from key when inclusive,
+        or over all keys when key is None. The keys must not change
+        while they are iterated.
+        """
+        i, j = 0, 0
+        if key is not None:
+            find = bisect_left if inclusive else bisect_right
+            i = find(self.maxes, key)
+            if i < len(self.blocks):
+                j = find(self.blocks[i], key)
+        if i < len(self.blocks):
+            yield from self.blocks[i][j:]
+        for k in range(i + 1, len(self.blocks)):
+            yield from self.blocks[k]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+""" Stats module
+
+Counters of the objects of a model class, kept up to date as objects
+are stored and removed, so that they are read without a scan.
+"""
+from collections import Counter
+from datetime import date, timedelta
+from typing import Iterable, Tuple
+
+from models.sorted_keys import SortedKeys
+
+
+MINUTE = 60
+DAY = 86400
+EPOCH = date(1970, 1, 1)
+
+
+class Stats():
+    """ Number of objects, counted by second, minute and day of creation.
+    Adding or discarding an object updates three counters, and the
+    minutes holding objects are kept in order to count the ones created
+    since any time.
+    """
+
+    def __init__(self, created: Iterable[Tuple[str, int]] = ()):
+        """ Count objects from (id, creation time in seconds since the
+        epoch) pairs
+        """
+        self.created = dict(created)
+        self.seconds = dict(Counter(self.created.values()))
+        self.minutes = {}
+        self.days = {}
+        for second, count in self.seconds.items():
+            minute, day = second // MINUTE, second // DAY
+            self.minutes[minute] = self.minutes.get(minute, 0) + count
+            self.days[day] = self.days.get(day, 0) + count
+        self.order = SortedKeys(self.minutes)
+
+    def _count(self, seconds: int, step: int):
+        """ Add step to the counters of a creation time
+        """
+        minute = seconds // MINUTE
+        for counts, key in ((self.seconds, seconds),
+                            (self.minutes, minute),
+                            (self.days, seconds // DAY)):
+            count = counts.get(key, 0) + step
+            if count:
+                counts[key] = count
+            else:
+                del counts[key]
+        if minute not in self.minutes:
+            self.order.discard(minute)
+        elif step > 0 and self.minutes[minute] == step:
+            self.order.add(minute)
+
+    def add(self, obj_id: str, seconds: int):
+        """ Count an object created at seconds since the epoch, in place
+        of its previous creation time if it differs
+        """
+        previous = self.created.get(obj_id)
+        if previous == seconds:
+            return
+        if previous is not None:
+            self._count(previous, -1)
+        self.created[obj_id] = seconds
+        self._count(seconds, 1)
+
+    def discard(self, obj_id: str):
+        """ Stop counting an object, if it was
+        """
+        seconds = self.created.pop(obj_id, None)
+        if seconds is not None:
+            self._count(seconds, -1)
+
+    def count(self) -> int:
+        """ Number of objects
+        """
+        return len(self.created)
+
+    def created_since(self, seconds: int) -> int:
+        """ Number of objects created at or after seconds since the epoch,
+        from the seconds left in its minute and the minutes after it
+        """
+        minute = seconds // MINUTE
+        total = sum(self.seconds.get(second, 0)
+                    for second in range(seconds, (minute + 1) * MINUTE))
+        for later in self.order.after(minute):
+            total += self.minutes[later]
+        return total
+
+    def per_day(self) -> dict:
+        """ Number of objects created on each day, by ISO date
+        """
+        return {
+            (EPOCH + timedelta(days=day)).isoformat(): self.days[day]
+            for day in sorted(self.days)
+        }
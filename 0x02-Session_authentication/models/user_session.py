@@ -9,6 +9,9 @@ class UserSession(Base):
     User session class implementations
     """
 
+    __slots__ = ('user_id', 'session_id')
+    indexed_attributes = ("session_id",)
+
     def __init__(self, *args: list, **kwargs: dict):
         """Initializes a User session instance."""
         super().__init__(*args, **kwargs)
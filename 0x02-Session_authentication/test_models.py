@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+""" Tests of the models store: indexes, journal, queries, stats and
+concurrent access, each run in an empty temporary directory
+"""
+from datetime import datetime, timedelta
+from unittest import mock
+import os
+import tempfile
+import threading
+import unittest
+
+import bench_models
+from models import base
+from models.base import DATA, IDS, INDEXES
+from models.user import User
+
+
+class StoreTestCase(unittest.TestCase):
+    """ Runs each test on an empty User store in a temporary directory
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        User.load_from_file()
+
+    def tearDown(self):
+        base.flush()
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def make_users(self, count: int) -> list:
+        users = []
+        for i in range(count):
+            user = User(email="user{}@example.com".format(i % 5))
+            user.save()
+            users.append(user)
+        return users
+
+    def assert_indexed(self):
+        entries, keys = INDEXES["User"]["email"]
+        users = DATA["User"]
+        self.assertEqual(set(keys), set(users))
+        for obj_id, user in users.items():
+            self.assertIs(entries[user.email][obj_id], user)
+        self.assertEqual(
+            sum(len(matches) for matches in entries.values()), len(users)
+        )
+        self.assertEqual(list(IDS["User"].after()), sorted(users))
+
+
+class IndexTest(StoreTestCase):
+    """ The email index and the sorted ids follow saves, removes and
+    loads
+    """
+
+    def test_save_and_search(self):
+        users = self.make_users(10)
+        self.assert_indexed()
+        found = User.search({"email": "user3@example.com"})
+        self.assertEqual(
+            sorted(user.id for user in found),
+            sorted(user.id for user in users[3::5]),
+        )
+
+    def test_change_and_remove(self):
+        users = self.make_users(10)
+        users[0].email = "moved@example.com"
+        users[0].save()
+        users[1].remove()
+        self.assert_indexed()
+        self.assertEqual(User.search({"email": "moved@example.com"}),
+                         [users[0]])
+        self.assertEqual(len(User.search({"email": "user1@example.com"})),
+                         1)
+        self.assertIsNone(User.get(users[1].id))
+
+    def test_load(self):
+        users = self.make_users(10)
+        users[2].remove()
+        User.load_from_file()
+        self.assert_indexed()
+        self.assertEqual(User.count(), 9)
+        self.assertEqual(len(User.search({"email": "user0@example.com"})),
+                         2)
+
+
+@mock.patch.object(base, "STORAGE_MODE", "journal")
+class JournalTest(StoreTestCase):
+    """ The journal is replayed on load, and only a torn last record is
+    cut off
+    """
+
+    def stored(self) -> dict:
+        return {obj_id: user.to_json(True)
+                for obj_id, user in DATA["User"].items()}
+
+    def test_replay(self):
+        users = self.make_users(5)
+        users[0].first_name = "Bob"
+        users[0].save()
+        users[1].remove()
+        stored = self.stored()
+        self.assertFalse(os.path.exists(".db_User.json"))
+        User.load_from_file()
+        self.assertEqual(self.stored(), stored)
+        self.assertEqual(User.get(users[0].id).first_name, "Bob")
+
+    def test_torn_last_record(self):
+        self.make_users(3)
+        stored = self.stored()
+        size = os.path.getsize(".db_User.journal")
+        with open(".db_User.journal", "ab") as f:
+            f.write(b'0badc0de\t{"op": "save", "id": "tor')
+        User.load_from_file()
+        self.assertEqual(self.stored(), stored)
+        self.assertEqual(os.path.getsize(".db_User.journal"), size)
+        User(email="after@example.com").save()
+        User.load_from_file()
+        self.assertEqual(User.count(), 4)
+
+    def test_corrupted_record_in_the_middle(self):
+        self.make_users(5)
+        with open(".db_User.journal", "rb") as f:
+            data = f.read()
+        second = data.index(b"\n") + 1
+        corrupted = data[:second + 20] + b"X" + data[second + 21:]
+        with open(".db_User.journal", "wb") as f:
+            f.write(corrupted)
+        with self.assertRaises(ValueError):
+            User.load_from_file()
+        with open(".db_User.journal", "rb") as f:
+            self.assertEqual(f.read(), corrupted)
+
+
+class QueryTest(StoreTestCase):
+    """ first(), limit(), offset() and id cursors return the objects in
+    id order
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.ids = sorted(user.id for user in self.make_users(25))
+
+    def test_first(self):
+        self.assertEqual(User.query().order_by("id").first().id,
+                         self.ids[0])
+        self.assertIsNone(
+            User.query({"email": "nobody@example.com"}).first()
+        )
+        self.assertIsNone(User.query().limit(0).first())
+
+    def test_limit_and_offset(self):
+        query = User.query().order_by("id")
+        self.assertEqual([user.id for user in query.limit(10)],
+                         self.ids[:10])
+        for paged in (query.offset(5).limit(10), query.limit(10).offset(5)):
+            self.assertEqual([user.id for user in paged], self.ids[5:15])
+        self.assertEqual([user.id for user in query.offset(20)],
+                         self.ids[20:])
+        self.assertEqual(User.query().count(), 25)
+
+    def test_cursor_pagination(self):
+        pages = []
+        cursor = ""
+        while True:
+            page = User.query().where("id", ">", cursor) \
+                .order_by("id").limit(7).all()
+            if not page:
+                break
+            pages.append([user.id for user in page])
+            cursor = page[-1].id
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 4])
+        self.assertEqual(sum(pages, []), self.ids)
+
+    def test_scan_by_chunks(self):
+        with mock.patch.object(base, "SCAN_CHUNK_SIZE", 4):
+            self.assertEqual([user.id for user in User.query()], self.ids)
+            self.assertEqual(
+                User.query().where("id", ">=", self.ids[10]).count(), 15
+            )
+
+
+class StatsTest(StoreTestCase):
+    """ The counters of stats() follow saves and removes
+    """
+
+    def test_counters(self):
+        now = datetime(2024, 5, 10, 12)
+        users = []
+        for hours in (0, 1, 30, 50, 50):
+            user = User(email="user@example.com")
+            user.created_at = now - timedelta(hours=hours)
+            user.save()
+            users.append(user)
+        stats = User.stats(now - timedelta(hours=1))
+        self.assertEqual(stats["count"], 5)
+        self.assertEqual(stats["since"], 2)
+        self.assertEqual(stats["per_day"], {
+            "2024-05-08": 2, "2024-05-09": 1, "2024-05-10": 2,
+        })
+        users[3].remove()
+        users[0].created_at = now - timedelta(hours=30)
+        users[0].save()
+        stats = User.stats(now - timedelta(hours=1))
+        self.assertEqual(stats["count"], 4)
+        self.assertEqual(stats["since"], 1)
+        self.assertEqual(stats["per_day"], {
+            "2024-05-08": 1, "2024-05-09": 2, "2024-05-10": 1,
+        })
+        User.load_from_file()
+        self.assertEqual(User.stats(now - timedelta(hours=1)), stats)
+
+
+class StressTest(StoreTestCase):
+    """ Concurrent saves, removes and searches leave the store, its
+    indexes and its file consistent
+    """
+
+    def test_threads(self):
+        errors = []
+        workers = [
+            threading.Thread(target=bench_models.stress_worker,
+                             args=(200, seed, errors))
+            for seed in range(8)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(bench_models.check_store(), [])
+        self.assert_indexed()
+
+
+if __name__ == "__main__":
+    unittest.main()
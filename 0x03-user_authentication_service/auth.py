@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 """
 Model that authenticates users
+
+The bcrypt cost is set per deployment with BCRYPT_ROUNDS, or
+calibrated on startup for a verification latency of
+BCRYPT_TARGET_MS milliseconds.
 """
 import bcrypt
+import os
+import time
+from functools import lru_cache
 from uuid import uuid4
 from typing import Union
 from sqlalchemy.orm.exc import NoResultFound
@@ -12,11 +19,60 @@ from db import DB
 from user import User
 
 
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 4
+MAX_ROUNDS = 20
+
+
+def _calibrate_rounds(target_ms: float) -> int:
+    """
+    Picks the highest cost whose verification fits in target_ms,
+    timing one hash at each cost from the lowest up: a verification
+    does the same work as a hash, and each cost doubles it
+    """
+    sample = b"calibration"
+    rounds = MIN_ROUNDS
+    while rounds < MAX_ROUNDS:
+        start = time.perf_counter()
+        bcrypt.hashpw(sample, bcrypt.gensalt(rounds + 1))
+        if (time.perf_counter() - start) * 1000 > target_ms:
+            break
+        rounds += 1
+    return rounds
+
+
+@lru_cache(maxsize=None)
+def _bcrypt_rounds() -> int:
+    """
+    Returns the bcrypt cost of this deployment. BCRYPT_ROUNDS and
+    BCRYPT_TARGET_MS mean the same as for the encrypt_password
+    module of 0x00-personal_data, calibrated the same way.
+    """
+    rounds = os.getenv("BCRYPT_ROUNDS")
+    if rounds:
+        return int(rounds)
+    target_ms = os.getenv("BCRYPT_TARGET_MS")
+    if target_ms:
+        return _calibrate_rounds(float(target_ms))
+    return DEFAULT_ROUNDS
+
+
+def _needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Checks if a hashed password uses another cost than the policy
+    """
+    try:
+        return int(hashed_password.split(b"$")[2]) != _bcrypt_rounds()
+    except (IndexError, ValueError):
+        return True
+
+
 def _hash_password(password: str) -> bytes:
     """
     Method that hashes a password
     """
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    salt = bcrypt.gensalt(_bcrypt_rounds())
+    return bcrypt.hashpw(password.encode("utf-8"), salt)
 
 
 def _generate_uuid() -> str:
@@ -28,8 +84,12 @@ class Auth:
     """Auth class to interact with the authentication database."""
 
     def __init__(self):
-        """Initializes a new Auth instance."""
+        """
+        Initializes a new Auth instance, settling the bcrypt cost
+        now rather than in the first request that hashes a password
+        """
         self._db = DB()
+        _bcrypt_rounds()
 
     def register_user(self, email: str, password: str) -> User:
         """Adds a new user to the database."""
@@ -41,19 +101,26 @@ class Auth:
 
     def valid_login(self, email: str, password: str) -> bool:
         """
-        This method checks for valid user credentials
+        This method checks for valid user credentials and upgrades
+        a matching hash made with an outdated cost
         """
         user = None
         try:
             user = self._db.find_user_by(email=email)
-            if user is not None:
-                return bcrypt.checkpw(
-                    password.encode("utf-8"),
-                    user.hashed_password,
-                )
         except NoResultFound:
             return False
-        return False
+        if user is None:
+            return False
+        valid = bcrypt.checkpw(
+            password.encode("utf-8"),
+            user.hashed_password,
+        )
+        if valid and _needs_rehash(user.hashed_password):
+            self._db.update_user(
+                user.id,
+                hashed_password=_hash_password(password),
+            )
+        return valid
 
     def create_session(self, email: str) -> str:
         """Creates a new session for a user based